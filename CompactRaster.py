@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+from RasterStats import StatsAccumulator
+from Tiling import TileConfig, accumulate_raster
+from TiledRaster import FileBackend
+
+# Compressed archive format for outputs. <path>.blocks holds every written block as zlib compressed
+# bytes, the stored values followed by the NoData bitmask. <path>.json is the sidecar with the shape,
+# stored dtype, quantization scale and offset, the byte ranges of every block and the statistics
+# and histogram of the values before quantization.
+
+# stored dtype -> largest code, values are quantized onto 0..largest code over the value range
+QUANTIZED_TYPES = {'uint8': 255, 'uint16': 65535}
+COMPRESSION_LEVEL = 6
+# decoded blocks kept per raster, for reads that are not aligned with the written blocks
+BLOCK_CACHE_SIZE = 8
+
+
+class CompactRaster:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path + '.json') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        # None for float32 storage, else 'uint8' or 'uint16'
+        self.quantize = meta['quantize']
+        self.scale = meta['scale']
+        self.offset = meta['offset']
+        # histogram range of the stats, None when it was not given
+        self.value_range = None if meta['value_range'] is None else tuple(meta['value_range'])
+        self.level = meta['level']
+        self.transform = tuple(meta['transform'])
+        self.name = meta['name']
+        self.spatial_reference = meta['spatial_reference']
+        # (row, col) -> [nrows, ncols, byte offset, data bytes, mask bytes], mask bytes 0 without NoData
+        self.blocks = OrderedDict(((b[0], b[1]), b[2:]) for b in meta['blocks'])
+        self.stats = meta.get('stats')
+        self.counts = meta.get('counts')
+        self.mode = 'r'
+        # writer while mode is 'w', blocks are read through their own handle
+        self._file = None
+        self._reader = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._decoded = OrderedDict()
+
+    @classmethod
+    def create(cls, path, shape, quantize=None, value_range=None, level=COMPRESSION_LEVEL,
+               transform=(0, 1, 0, 0, 0, -1), name='raster', spatial_reference=None):
+        # quantize='uint8' keeps the values to within (max - min) / 510 of value_range, 'uint16' to
+        # within (max - min) / 131070. Values outside value_range are clipped to its ends.
+        if quantize is None:
+            dtype, scale, offset = np.dtype(np.float32), None, None
+        elif quantize in QUANTIZED_TYPES:
+            if value_range is None:
+                raise ValueError('Quantization needs the value_range of the raster')
+            lo, hi = float(value_range[0]), float(value_range[1])
+            dtype, offset = np.dtype(quantize), lo
+            scale = (hi - lo) / QUANTIZED_TYPES[quantize] if hi > lo else 1.0
+        else:
+            raise ValueError('Unknown quantization: {}, use one of {}'.format(quantize, list(QUANTIZED_TYPES)))
+        meta = {'shape': list(shape), 'dtype': dtype.str, 'quantize': quantize, 'scale': scale, 'offset': offset,
+                'value_range': None if value_range is None else list(value_range), 'level': level,
+                'transform': list(transform), 'name': name, 'spatial_reference': spatial_reference, 'blocks': []}
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+        raster = cls(path)
+        raster.mode = 'w'
+        raster._file = open(raster.path + '.blocks', 'wb')
+        return raster
+
+    @classmethod
+    def from_raster(cls, backend, raster, path, quantize=None, value_range=None, config=None,
+                    level=COMPRESSION_LEVEL):
+        # streams any backend raster into the compact format, one tile at a time
+        if value_range is None:
+            stats = backend.statistics(raster)
+            value_range = (stats['min'], stats['max'])
+        config = config if config is not None else TileConfig()
+        height, width = backend.shape(raster)
+        compact = cls.create(path, (height, width), quantize, value_range, level,
+                             getattr(raster, 'transform', (0, 1, 0, 0, 0, -1)), backend.name(raster),
+                             getattr(raster, 'spatial_reference', None))
+        compact_backend = CompactBackend()
+        stats = StatsAccumulator(value_range)
+        for row, col, nrows, ncols in config.tiles(height, width):
+            values = backend.read(raster, row, col, nrows, ncols)
+            stats.update(values)
+            compact_backend.write(compact, values, row, col)
+        compact_backend.set_statistics(compact, stats)
+        compact.close()
+        return compact
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    @property
+    def tolerance(self):
+        # largest difference between a value written and the value read back, beyond float32 rounding
+        return 0.0 if self.scale is None else self.scale / 2
+
+    def nbytes(self):
+        # compressed size on disk, sidecar excluded
+        return sum(block[3] + block[4] for block in self.blocks.values())
+
+    def accumulator(self):
+        # StatsAccumulator with the histogram accumulated while the raster was written
+        if self.stats is None:
+            return None
+        return StatsAccumulator.from_state(self.stats, self.counts)
+
+    def encode(self, values):
+        values = np.asarray(values)
+        missing = np.isnan(values)
+        if self.scale is None:
+            stored = np.where(missing, 0, values).astype(self.dtype)
+        else:
+            with np.errstate(invalid='ignore'):
+                codes = np.rint((values - self.offset) / self.scale)
+            codes[missing] = 0
+            stored = np.clip(codes, 0, QUANTIZED_TYPES[self.quantize]).astype(self.dtype)
+        # bytes of equal significance next to each other, the high bytes of nearby values compress well
+        shuffled = stored.reshape(-1).view(np.uint8).reshape(-1, self.dtype.itemsize).T
+        data = zlib.compress(np.ascontiguousarray(shuffled).tobytes(), self.level)
+        mask = zlib.compress(np.packbits(missing, axis=None).tobytes(), self.level) if missing.any() else b''
+        return data, mask
+
+    def decode(self, nrows, ncols, data, mask):
+        shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(self.dtype.itemsize, -1)
+        stored = np.ascontiguousarray(shuffled.T).view(self.dtype).reshape(nrows, ncols)
+        if self.scale is None:
+            values = stored.copy()
+        else:
+            values = (stored * self.scale + self.offset).astype(np.float32)
+        if mask:
+            missing = np.unpackbits(np.frombuffer(zlib.decompress(mask), dtype=np.uint8), count=nrows * ncols)
+            values[missing.reshape(nrows, ncols).astype(bool)] = np.nan
+        return values
+
+    def append(self, row, col, values):
+        # blocks are written once, each pass of the tile loop writes every cell exactly once
+        if self.mode != 'w':
+            raise ValueError('{} was closed, compact rasters are written once'.format(self.name))
+        data, mask = self.encode(values)
+        self._file.write(data)
+        self._file.write(mask)
+        self.blocks[(row, col)] = [values.shape[0], values.shape[1], self._size, len(data), len(mask)]
+        self._size += len(data) + len(mask)
+
+    def block(self, key):
+        with self._lock:
+            if key in self._decoded:
+                self._decoded.move_to_end(key)
+                return self._decoded[key]
+            nrows, ncols, start, n_data, n_mask = self.blocks[key]
+            if self._file is not None:
+                self._file.flush()
+            if self._reader is None:
+                self._reader = open(self.path + '.blocks', 'rb')
+            self._reader.seek(start)
+            data = self._reader.read(n_data)
+            mask = self._reader.read(n_mask)
+        values = self.decode(nrows, ncols, data, mask)
+        with self._lock:
+            self._decoded[key] = values
+            if len(self._decoded) > BLOCK_CACHE_SIZE:
+                self._decoded.popitem(last=False)
+        return values
+
+    def flush(self):
+        if self.mode == 'w':
+            self._file.flush()
+            meta = {'shape': list(self.shape), 'dtype': self.dtype.str, 'quantize': self.quantize,
+                    'scale': self.scale, 'offset': self.offset,
+                    'value_range': None if self.value_range is None else list(self.value_range),
+                    'level': self.level, 'transform': list(self.transform), 'name': self.name,
+                    'spatial_reference': self.spatial_reference,
+                    'blocks': [list(key) + block for key, block in self.blocks.items()],
+                    'stats': self.stats, 'counts': self.counts}
+            with open(self.path + '.json', 'w') as f:
+                json.dump(meta, f)
+
+    def close(self):
+        # finishes writing, the raster stays readable
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.mode = 'r'
+
+
+class CompactBackend(FileBackend):
+    # blocks are read under a lock and decoded in the calling thread
+    thread_safe = True
+
+    def identity(self, raster):
+        return {'path': raster.path, 'mtime': os.path.getmtime(raster.path + '.json')}
+
+    def read(self, raster, row, col, nrows, ncols):
+        key = (row, col)
+        if key in raster.blocks and raster.blocks[key][:2] == [nrows, ncols]:
+            return raster.block(key)
+        values = np.full((nrows, ncols), np.nan, dtype=np.float32)
+        for (r0, c0), (bh, bw) in [(key, block[:2]) for key, block in raster.blocks.items()]:
+            r1, c1 = min(row + nrows, r0 + bh), min(col + ncols, c0 + bw)
+            top, left = max(row, r0), max(col, c0)
+            if top < r1 and left < c1:
+                values[top - row:r1 - row, left - col:c1 - col] = \
+                    raster.block((r0, c0))[top - r0:r1 - r0, left - c0:c1 - c0]
+        return values
+
+    def write(self, raster, values, row, col):
+        raster.append(row, col, values)
+        raster.stats = None
+        raster.counts = None
+
+    def create_like(self, raster):
+        return self.track(CompactRaster.create(self.new_path(raster.name), (raster.height, raster.width),
+                                               transform=raster.transform, name=raster.name,
+                                               spatial_reference=raster.spatial_reference))
+
+    def calculate_statistics(self, raster):
+        self.set_statistics(raster, accumulate_raster(self, raster, TileConfig(), raster.value_range))
+
+    def set_statistics(self, raster, stats):
+        # kept in the sidecar with the histogram, so they describe the values before quantization
+        raster.stats, raster.counts = stats.state()
+        if raster.counts is not None:
+            raster.counts = raster.counts.tolist()
+        raster.flush()
+
+    def statistics(self, raster):
+        if raster.stats is None:
+            self.calculate_statistics(raster)
+        return raster.accumulator().as_dict()
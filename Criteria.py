@@ -1,341 +1,386 @@
-import arcpy
-import math
+import copy
+import os
+import numpy as np
 import matplotlib.pyplot as plt
+import Jobs
+from Tiling import *
+from RasterBackend import *
+from RasterStats import *
+from Expression import *
+from TransformCache import *
+from Remap import *
+from Pyramid import *
+from CompactRaster import *
+from TransformFunctions import *
+from Profiling import NULL_PROFILER
 
 
 class Criteria:
-    def __init__(self, raster_obj):
+    def __init__(self, raster_obj, tile_config=None, backend=None, cache=None, profiler=None, sampling=None):
         self.raster = raster_obj
-        raster_info = raster_obj.getRasterInfo()
-        raster_info.setPixelType('F32')
-        self.transformed_raster = arcpy.Raster(raster_info)
-        self.scaled_transformed_raster = arcpy.Raster(raster_info)
-        self.min_value = raster_obj.minimum
-        self.max_value = raster_obj.maximum
-        self.mean_value = raster_obj.mean
-        self.std_value = raster_obj.standardDeviation
-        self.values = self.get_raster_values(raster_obj)
-        interv = (max(self.values) - min(self.values)) / (100 - 1)
-        self.sample_values = [min(self.values) + i * interv for i in range(100)]
+        if tile_config is None:
+            # tiled sources are walked on their own tile grid, every read is then a zero copy view
+            tile_config = TileConfig(getattr(raster_obj, 'tile_shape', DEFAULT_TILE_SHAPE))
+        self.tile_config = tile_config
+        self.backend = backend if backend is not None else get_backend(raster_obj)
+        self.name = self.backend.name(raster_obj)
+        self.source = SourceNode(raster_obj, self.backend)
+        # lazy transformed values, rasters and statistics are only produced on demand
+        self.expression = None
+        self.transformed_range = None
+        self._transformed_raster = None
+        self._transformed_stats = None
+        # optional TransformCache, warm starts skip the source scan and the transforms
+        self.cache = cache
+        self.source_key = self.backend.identity(raster_obj) if cache is not None else None
+        # optional Profiler, times and counts every stage of this criterion
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        # overview levels of the source built by preview(), level -> NumpyRaster; with preview_level
+        # set the transform, its statistics and rasters are computed on that level instead
+        self.pyramid = {}
+        self.preview_level = None
+        self.transform_args = None
+        # last Job started by transform_async()
+        self.job = None
+        # bumped by every transform()
+        self.version = 0
+        # Sampling of the source statistics, by default exact moments from the backend and a sampled histogram
+        self.sampling = sampling if sampling is not None else Sampling()
+        with self.profiler.stage('source_statistics'):
+            self.load_source_statistics()
+        interv = (self.max_value - self.min_value) / (100 - 1)
+        self.sample_values = [self.min_value + i * interv for i in range(100)]
         self.transformed_sample_values = self.sample_values.copy()
 
+    def load_source_statistics(self):
+        cache = self.cache
+        key = cache_key('source', self.source_key, self.sampling.key()) if cache is not None else None
+        entry = cache.get(key) if cache is not None else None
+        sample = None
+        if entry is not None:
+            meta, arrays = entry
+            stats = meta['raster_stats']
+            self.stats = StatsAccumulator.from_state(meta['stats'], arrays['counts'])
+        elif self.sampling.method == 'sample' and not self.sampling.covers(*self.backend.shape(self.raster)):
+            sample = sample_valid_values(self.backend, self.raster, self.sampling)
+            stats = StatsAccumulator().update(sample).as_dict()
+        elif self.sampling.method == 'sample':
+            stats = accumulate_raster(self.backend, self.raster, self.tile_config).as_dict()
+        else:
+            stats = self.backend.statistics(self.raster)
+        self.min_value = stats['min']
+        self.max_value = stats['max']
+        self.mean_value = stats['mean']
+        self.std_value = stats['std']
+        if entry is None:
+            # plots are served from this histogram state afterwards
+            value_range = (self.min_value, self.max_value)
+            if self.sampling.covers(*self.backend.shape(self.raster)):
+                self.stats = accumulate_raster(self.backend, self.raster, self.tile_config, value_range)
+            else:
+                if sample is None:
+                    sample = sample_valid_values(self.backend, self.raster, self.sampling)
+                self.stats = StatsAccumulator(value_range).update(sample)
+            if cache is not None:
+                state, counts = self.stats.state()
+                cache.put(key, {'raster_stats': stats, 'stats': state}, {'counts': counts})
+
+    def source_summary(self):
+        return SourceStats(self.min_value, self.max_value, self.mean_value, self.std_value)
+
     def get_raster_values(self, raster):
-        x = []
-        for r, c in raster:
-            x.append(raster[r, c])
-        # exclude nodata value, may take a while depending on raster size
-        return list(filter(lambda v: not math.isnan(v), x))
+        # exclude nodata value, holds every valid cell in memory so prefer the tiled helpers
+        with self.profiler.stage('get_raster_values'):
+            return np.concatenate(list(iter_valid_values(self.backend, raster, self.tile_config)))
+
+    def map(self, func):
+        # transform of the source, rounded to float32 like the values of a F32 raster
+        return MapNode(self.input_node(), func, np.float32)
+
+    def input_node(self):
+        if self.preview_level is None:
+            return self.source
+        return SourceNode(*self.input_raster())
+
+    def input_raster(self):
+        # (raster, backend) the transform reads, the source or its preview level
+        if self.preview_level is None:
+            return self.raster, self.backend
+        return self.pyramid[self.preview_level], NumpyBackend()
+
+    def build_level(self, level):
+        with self.profiler.stage('build_pyramid'):
+            self.pyramid[level] = build_level(self.backend, self.raster, self.tile_config, level)
+
+    def preview(self, level=2):
+        # fast, approximate mode for tuning a transform: level k has one cell in 4**k of the source.
+        # Defaults of the params still come from the full resolution statistics
+        if level < 1:
+            raise ValueError('Preview levels start at 1, got {}'.format(level))
+        if level not in self.pyramid:
+            self.build_level(level)
+        self.preview_level = level
+        self.rerun_transform()
+
+    def full_resolution(self):
+        # leaves preview mode, the current transform is recomputed on every cell
+        if self.preview_level is not None:
+            self.preview_level = None
+            self.rerun_transform()
+
+    def rerun_transform(self):
+        self._transformed_raster = None
+        self._transformed_stats = None
+        if self.transform_args is not None:
+            self.transformed_sample_values = self.sample_values.copy()
+            self.transform(*copy.deepcopy(self.transform_args))
+
+    def transform_async(self, type, params, on_progress=None):
+        # transform() and the transformed statistics in a background Job, the criterion only takes
+        # the result once the job succeeds, so a cancelled or failed job leaves it unchanged
+        params = copy.deepcopy(params)
+        previous = self.job
+
+        def run():
+            other = copy.copy(self)
+            other.transformed_sample_values = list(self.transformed_sample_values)
+            other.transform(type, params)
+            other.transformed_stats
+            # last point where cancel() stops the job, after it the criterion takes the result
+            Jobs.check()
+            for name in ('expression', 'transformed_range', 'transformed_sample_values', 'transform_args',
+                         '_transformed_raster', '_transformed_stats', 'version'):
+                setattr(self, name, getattr(other, name))
+            return self
+
+        lock = None if getattr(self.backend, 'thread_safe', False) else Jobs.SERIAL_LOCK
+        # transforms of one criterion apply in the order they were started
+        after = [previous] if previous is not None and not previous.done() else []
+        job = self.job = Jobs.Job('transform {}'.format(self.name), on_progress).start(run, after, lock)
+        # the callback may already have run and reset self.job
+        job.add_done_callback(self._forget_job)
+        return job
+
+    def _forget_job(self, job):
+        # a cancelled or failed transform left the criterion as it was, later jobs need not wait for it
+        if self.job is job and (job.cancelled() or job.exception() is not None):
+            self.job = None
+
+    def variant(self, type, params):
+        # copy of this criterion with another transform, sharing the source and its statistics so
+        # both can be evaluated in one pass
+        other = copy.copy(self)
+        other.transformed_sample_values = self.sample_values.copy()
+        other._transformed_raster = None
+        other._transformed_stats = None
+        other.transform(type, params)
+        return other
+
+    def preview_error(self):
+        # estimated distance of the preview statistics from the full resolution ones, None at full resolution
+        if self.preview_level is None or self.transformed_stats is None:
+            return None
+        height, width = self.backend.shape(self.raster)
+        fraction = float(np.prod(level_shape(height, width, self.preview_level))) / (height * width)
+        return sampling_error(self.transformed_stats, fraction)
+
+    def value_range(self):
+        # bounds of the transformed values known without reading the raster
+        return self.transformed_range
+
+    def store_transform(self, key):
+        # materializes the transform as a tiled raster in the cache entry and reads it back memory mapped
+        with self.profiler.stage('store_transform'):
+            self._store_transform(key)
+
+    def _store_transform(self, key):
+        try:
+            path = self.cache.pending_path(key)
+            os.makedirs(path, exist_ok=True)
+            raster = TiledRaster.create(os.path.join(path, 'transformed'), self.backend.shape(self.raster),
+                                        self.tile_config.tile_shape, name=self.name)
+            stats = StatsAccumulator(self.transformed_range)
+            evaluate([Output(self.expression, raster, TiledBackend(), stats)], self.tile_config)
+            raster.flush()
+            del raster
+            state, counts = stats.state()
+            meta = {'stats': state, 'value_range': self.transformed_range}
+            arrays = {'counts': counts, 'transformed_sample_values': np.array(self.transformed_sample_values)}
+            entry = self.cache.put(key, meta, arrays)
+        except BaseException:
+            self.cache.discard(key)
+            raise
+        self.load_transform(key, *entry)
+
+    def load_transform(self, key, meta, arrays):
+        raster = TiledRaster(os.path.join(self.cache.entry_path(key), 'transformed'))
+        self.expression = SourceNode(raster, TiledBackend())
+        self.transformed_range = tuple(meta['value_range'])
+        self.transformed_sample_values = [float(v) for v in arrays['transformed_sample_values']]
+        self._transformed_stats = StatsAccumulator.from_state(meta['stats'], arrays['counts'])
+        self._transformed_raster = None
+
+    def materialize(self, path):
+        # writes the transformed values to a tiled raster at path, the model then reads them back
+        # as zero copy views instead of recomputing the transform
+        if self.preview_level is not None:
+            raise ValueError('Call full_resolution() before materializing a criterion')
+        raster = TiledRaster.create(path, self.backend.shape(self.raster), self.tile_config.tile_shape,
+                                    transform=getattr(self.raster, 'transform', (0, 1, 0, 0, 0, -1)), name=self.name,
+                                    spatial_reference=getattr(self.raster, 'spatial_reference', None))
+        stats = StatsAccumulator(self.value_range())
+        with self.profiler.stage('materialize'):
+            evaluate([Output(self.expression, raster, TiledBackend(), stats)], self.tile_config)
+            TiledBackend().set_statistics(raster, stats)
+        self.expression = SourceNode(raster, TiledBackend())
+        self._transformed_stats = stats
+        self._transformed_raster = raster
+        return raster
+
+    def export(self, path, quantize=None, level=COMPRESSION_LEVEL):
+        # writes the scaled values to a compressed raster at path for archiving, quantize='uint8' or
+        # 'uint16' stores codes over the transformed range, see CompactRaster.create
+        if self.preview_level is not None:
+            raise ValueError('Call full_resolution() before exporting a criterion')
+        raster = CompactRaster.create(path, self.backend.shape(self.raster), quantize, self.value_range(), level,
+                                      getattr(self.raster, 'transform', (0, 1, 0, 0, 0, -1)), self.name,
+                                      getattr(self.raster, 'spatial_reference', None))
+        stats = StatsAccumulator(self.value_range())
+        with self.profiler.stage('export'):
+            evaluate([Output(self.expression, raster, CompactBackend(), stats)], self.tile_config)
+            CompactBackend().set_statistics(raster, stats)
+        raster.close()
+        return raster
+
+    @property
+    def transformed_stats(self):
+        if self._transformed_stats is None and self.expression is not None:
+            stats = StatsAccumulator(self.value_range())
+            with self.profiler.stage('transformed_stats'):
+                evaluate([Output(self.expression, stats=stats)], self.tile_config)
+            self._transformed_stats = stats
+        return self._transformed_stats
+
+    @property
+    def transformed_raster(self):
+        # materialized on first access, e.g. for rendering, the model never needs it
+        if self._transformed_raster is None:
+            like, backend = self.input_raster()
+            raster = backend.create_like(like)
+            if self.expression is not None:
+                stats = StatsAccumulator(self.value_range())
+                with self.profiler.stage('transformed_raster'):
+                    evaluate([Output(self.expression, raster, backend, stats)], self.tile_config)
+                    backend.set_statistics(raster, stats)
+                self._transformed_stats = stats
+            self._transformed_raster = raster
+        return self._transformed_raster
 
     def show_stats(self, raster):
-        print('Mean: {}'.format(raster.mean))
-        print('Min: {}'.format(raster.minimum))
-        print('Max: {}'.format(raster.maximum))
+        stats = self.backend.statistics(raster)
+        print('Mean: {}'.format(stats['mean']))
+        print('Min: {}'.format(stats['min']))
+        print('Max: {}'.format(stats['max']))
+
+    def count_label(self):
+        # the source histogram counts sampled cells unless the sampling read every cell
+        return 'Count' if self.sampling.covers(*self.backend.shape(self.raster)) else 'Count (sample)'
 
     def show_hist(self, n_bins=20):
+        counts, edges = self.stats.histogram(n_bins)
         fig, ax1 = plt.subplots()
-        ax1.hist(self.values, bins=n_bins)
-        ax1.set_xlabel(self.raster.name)
-        ax1.set_ylabel('Count')
-        plt.title('Histogram of {}'.format(self.raster.name))
+        ax1.hist(edges[:-1], bins=edges, weights=counts)
+        ax1.set_xlabel(self.name)
+        ax1.set_ylabel(self.count_label())
+        plt.title('Histogram of {}'.format(self.name))
         plt.show()
 
     def transform(self, type, params):
+        with self.profiler.stage('transform'):
+            self._transform(type, params)
+        # models compare versions to find the criteria they have to recompute
+        self.version += 1
+
+    def _transform(self, type, params):
+        node = None
         if type == 'unique':
-            with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                for i, j in rci:
-                    old_cell_value = self.raster[i, j]
-                    if old_cell_value in params['remap']:
-                        self.transformed_raster[i, j] = params['remap'][old_cell_value]
+            node = self.map(UniqueRemap(params['remap']))
 
             for idx, val in enumerate(self.transformed_sample_values):
                 if val in params['remap']:
                     self.transformed_sample_values[idx] = params['remap'][val]
 
         if type == 'range':
-            with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                for i, j in rci:
-                    old_cell_value = self.raster[i, j]
-                    for s, e in params['remap']:
-                        if s < old_cell_value <= e:
-                            self.transformed_raster[i, j] = params['remap'][(s, e)]
+            node = self.map(RangeRemap(params['remap']))
 
         if type == 'continous':
-            # RBF Small method
-            if params['name'] == 'small':
-                if 'mid_point' not in params:
-                    params['mid_point'] = (self.max_value + self.min_value) / 2
-                if 'spread' not in params:
-                    params['spread'] = 5
-                self.transformed_sample_values = [1 / (1 + math.pow(i / params['mid_point'], params['spread']))
-                                                  for i in self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i,j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = 1 / (1 + math.pow(old_cell_value / params['mid_point'], params['spread']))
-
-            # RBF Large method
-            if params['name'] == 'large':
-                if 'mid_point' not in params:
-                    params['mid_point'] = (self.max_value + self.min_value) / 2
-                if 'spread' not in params:
-                    params['spread'] = -5
-                self.transformed_sample_values = [1 / (1 + math.pow(i / params['mid_point'], params['spread']))
-                                                  for i in self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = 1 / (
-                                    1 + math.pow(old_cell_value / params['mid_point'], params['spread']))
-
-            # RBF MSSmall method
-            if params['name'] == 'mssmall':
-                if 'mean_multiplier' not in params:
-                    params['mean_multiplier'] = 1
-                if 'std_multiplier' not in params:
-                    params['std_multiplier'] = 1
-                n_mean = params['mean_multiplier'] * self.mean_value
-                n_std = params['std_multiplier'] * self.std_value
-                self.transformed_sample_values = [n_std / (i - n_mean + n_std) if i > n_mean else 1 for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i,j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = n_std / (old_cell_value - n_mean + n_std) if old_cell_value > n_mean else 1
-
-            # RBF MSLarge method
-            if params['name'] == 'mslarge':
-                if 'mean_multiplier' not in params:
-                    params['mean_multiplier'] = 1
-                if 'std_multiplier' not in params:
-                    params['std_multiplier'] = 1
-                n_mean = params['mean_multiplier'] * self.mean_value
-                n_std = params['std_multiplier'] * self.std_value
-                self.transformed_sample_values = [1 - n_std / (i - n_mean + n_std) if i > n_mean else 0 for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = old_cell_value - n_std / (old_cell_value - n_mean + n_std) if old_cell_value > n_mean else 0
-
-            # RBF Gaussion method
-            if params['name'] == 'gaussian':
-                if 'mid_point' not in params:
-                    params['mid_point'] = (self.max_value + self.min_value) / 2
-                if 'spread' not in params:
-                    params['spread'] = math.log(10) * 4 / math.pow(params['mid_point'] - self.min_value, 2)
-                self.transformed_sample_values = [math.exp(-params['spread'] * (i - params['mid_point']) ** 2) for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = math.exp(-params['spread'] * (old_cell_value - params['mid_point']) ** 2)
-
-            # RBF Near method
-            if params['name'] == 'near':
-                if 'mid_point' not in params:
-                    params['mid_point'] = (self.max_value + self.min_value) / 2
-                if 'spread' not in params:
-                    params['spread'] = 36 / math.pow(params['mid_point'] - self.min_value, 2)
-                self.transformed_sample_values = [1 / (1 + params['spread'] * math.pow(i - params['mid_point'], 2))
-                                                  for i in self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = 1 / (1 + params['spread'] * math.pow(old_cell_value - params['mid_point'], 2))
-
-            # RBF Linear method
-            if params['name'] == 'linear':
-                if 'min_x' not in params:
-                    params['min_x'] = self.min_value
-                if 'max_x' not in params:
-                    params['max_x'] = self.max_value
-                diff = params['max_x'] - params['min_x']
-                y_sample = []
-                y = []
-                # positive slope, assume always the case
-                for v in self.sample_values:
-                    if v < params['min_x']:
-                        y_sample.append(0)
-                    else:
-                        if v > params['max_x']:
-                            y_sample.append(1)
-                        else:
-                            y_sample.append((v - params['min_x']) / diff)
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        if old_cell_value < params['min_x']:
-                            self.transformed_raster[i, j] = 0
-                        else:
-                            if old_cell_value > params['max_x']:
-                                self.transformed_raster[i, j] = 1
-                            else:
-                                self.transformed_raster[i, j] = (old_cell_value - params['min_x']) / diff
-                self.transformed_sample_values = y_sample
-
-            # RBF Symmetric Linear method
-            if params['name'] == 'symmetriclinear':
-                if 'min_x' not in params:
-                    params['min_x'] = self.min_value
-                if 'max_x' not in params:
-                    params['max_x'] = self.max_value
-                diff = params['max_x'] - params['min_x']
-                h_diff = 0.5 * diff
-                mid_p = params['min_x'] + h_diff
-                y_sample = []
-                y = []
-                for v in self.sample_values:
-                    if v < params['min_x']:
-                        y_sample.append(0)
-                    else:
-                        if v < mid_p:
-                            y_sample.append((v - params['min_x']) / h_diff)
-                        else:
-                            if v > params['max_x']:
-                                y_sample.append(0)
-                            else:
-                                y_sample.append((params['max_x'] - v) / h_diff)
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        if old_cell_value < params['min_x']:
-                            self.transformed_raster[i, j] = 0
-                        else:
-                            if old_cell_value < mid_p:
-                                self.transformed_raster[i, j] = (old_cell_value - params['min_x']) / h_diff
-                            else:
-                                if old_cell_value > params['max_x']:
-                                    self.transformed_raster[i, j] = 0
-                                else:
-                                    self.transformed_raster[i, j] = (params['max_x'] - old_cell_value) / h_diff
-                self.transformed_sample_values = y_sample
-
-            # RBF Exponential method
-            if params['name'] == 'exponential':
-                if 'in_shift' not in params:
-                    params['in_shift'] = (self.min_value * math.log(params['to_scale']) - self.max_value *
-                                          math.log(params['from_scale'])) / (math.log(params['to_scale']) -
-                                                                             math.log(params['from_scale']))
-                if 'base_factor' not in params:
-                    params['base_factor'] = (math.log(params['to_scale']) - math.log(params['from_scale'])) / \
-                                            (self.max_value - self.min_value)
-                self.transformed_sample_values = [math.exp((i - params['in_shift']) * params['base_factor'])
-                                                  for i in self.transformed_sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = math.exp((old_cell_value - params['in_shift']) * params['base_factor'])
-
-            # RBF Logarithm method
-            if params['name'] == 'logarithm':
-                if 'in_shift' not in params:
-                    params['in_shift'] = (self.min_value * math.exp(params['to_scale']) - self.max_value *
-                                          math.exp(params['from_scale'])) / (math.exp(params['to_scale']) -
-                                                                             math.exp(params['from_scale']))
-                if 'base_factor' not in params:
-                    params['base_factor'] = (math.exp(params['to_scale']) - math.exp(params['from_scale'])) / \
-                                            (self.max_value - self.min_value)
-                self.transformed_sample_values = [math.log((i - params['in_shift']) * params['base_factor'])
-                                                  for i in self.transformed_sample_values]
-
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = math.log((old_cell_value - params['in_shift']) * params['base_factor'])
-
-            # RBF Power method
-            if params['name'] == 'power':
-                if params['from_scale'] == 0:
-                    in_shift = self.min_value
-                    if params['to_scale'] <= 1:
-                        exponent = 1
-                    else:
-                        exponent = math.log(params['to_scale']) / (self.max_value - in_shift)
-                elif params['from_scale'] == 1:
-                    in_shift = self.min_value - 1
-                    exponent = math.log(params['to_scale']) / math.log(self.max_value - in_shift)
-                else:
-                    in_shift = self.min_value
-                    exponent = 2
-                if 'in_shift' not in params:
-                    params['in_shift'] = in_shift
-                if 'exponent' not in params:
-                    params['exponent'] = exponent
-
-                self.transformed_sample_values = [math.pow(i - params['in_shift'], params['exponent']) for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = math.pow(old_cell_value - params['in_shift'], params['exponent'])
-
-            # RBF Logistic Growth method
-            if params['name'] == 'logisticgrowth':
-                if 'y_intercept_percent' not in params:
-                    params['y_intercept_percent'] = 1
-                c = 100
-                a = c / params['y_intercept_percent'] - 1
-                b = - math.log(a) / (0.5 * (self.max_value + self.min_value) - self.min_value)
-                self.transformed_sample_values = [c / (1 + a * math.exp((i - self.min_value) * b)) for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = c / (1 + a * math.exp((old_cell_value - self.min_value) * b))
-
-            # RBF Logistic Decay method
-            if params['name'] == 'logisticdecay':
-                if 'y_intercept_percent' not in params:
-                    params['y_intercept_percent'] = 99
-                c = 100
-                a = c / params['y_intercept_percent'] - 1
-                b = - math.log(a) / (0.5 * (self.max_value + self.min_value) - self.min_value)
-                self.transformed_sample_values = [c / (1 + a * math.exp((i - self.min_value) * b)) for i in
-                                                  self.sample_values]
-                with arcpy.sa.RasterCellIterator({'rasters': [self.raster, self.transformed_raster]}) as rci:
-                    for i, j in rci:
-                        old_cell_value = self.raster[i, j]
-                        self.transformed_raster[i, j] = c / (1 + a * math.exp((old_cell_value - self.min_value) * b))
-
-
-            arcpy.CalculateStatistics_management(self.transformed_raster)
-            min_transformed_value = self.transformed_raster.minimum
-            max_transformed_value = self.transformed_raster.maximum
+            # registered RBF function, the same function object gives the plot curve and the raster
+            function = get_function(params['name'])
+            stats = self.source_summary()
+            function.defaults(params, stats)
+            self.transformed_sample_values = sample_curve(function, params, stats, self.sample_values)
+            node = self.map(function.bind(params, stats))
+
+        if node is None:
+            raise ValueError('Unknown transform type: {}'.format(type))
+
+        # kept so preview() and full_resolution() can redo the transform at another level. A private
+        # copy with the defaults filled in above, the rest of the transform and the cache key read it
+        # so later edits of the caller's dict do not change this transform
+        self.transform_args = (type, copy.deepcopy(params))
+        params = self.transform_args[1]
+        key = None
+        if self.cache is not None and self.preview_level is None:
+            # the function version keeps transforms of an older formula out of the cache
+            version = get_function(params['name']).version if type == 'continous' else None
+            # some functions read the source statistics besides params, and those depend on the sampling
+            key = cache_key('transform', self.source_key, type, params, version, tuple(self.source_summary()))
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.load_transform(key, *entry)
+                return
+
+        if type == 'continous':
+            # Final recale, the min/max of the transformed values take one read only pass
+            node = RescaleNode(node, params['from_scale'], params['to_scale'], np.float32)
+            with self.profiler.stage('rescale'):
+                resolve([node], self.tile_config)
+            min_transformed_value = node.minimum
+            max_transformed_value = node.maximum
             self.transformed_sample_values = [
                 (v - min_transformed_value) / (max_transformed_value - min_transformed_value) *
                 (params['to_scale'] - params['from_scale']) + params['from_scale'] for v in
                 self.transformed_sample_values]
+            self.transformed_range = (params['from_scale'], params['to_scale'])
+        else:
+            self.transformed_range = (min(params['remap'].values()), max(params['remap'].values()))
 
-            # Final recale
-            with arcpy.sa.RasterCellIterator({'rasters': [self.scaled_transformed_raster, self.transformed_raster]}) as rci:
-                for r, c in rci:
-                    self.scaled_transformed_raster[r, c] = (self.transformed_raster[r, c] - min_transformed_value) / (
-                        max_transformed_value - min_transformed_value) * (params['to_scale'] - params['from_scale']) + \
-                                            params['from_scale']
-            self.transformed_raster = self.scaled_transformed_raster
-
-        # Calculate statistics
-        arcpy.CalculateStatistics_management(self.transformed_raster)
+        self.expression = node
+        self._transformed_raster = None
+        self._transformed_stats = None
+        if key is not None:
+            self.store_transform(key)
 
     def show_transformed_hist(self, n_bins=20):
-        values = self.get_raster_values(self.transformed_raster)
+        counts, edges = self.transformed_stats.histogram(n_bins)
         fig, ax1 = plt.subplots()
-        ax1.hist(values, bins=n_bins)
-        ax1.set_xlabel(self.raster.name)
+        ax1.hist(edges[:-1], bins=edges, weights=counts)
+        ax1.set_xlabel(self.name)
         ax1.set_ylabel('Count')
-        plt.title('Histogram of transformed {}'.format(self.raster.name))
+        plt.title('Histogram of transformed {}'.format(self.name))
         plt.show()
 
     def show_transform_plot(self, n_bins=20):
+        counts, edges = self.stats.histogram(n_bins)
         fig, ax1 = plt.subplots()
         ax2 = ax1.twinx()
-        ax1.hist(self.values, bins=n_bins)
+        ax1.hist(edges[:-1], bins=edges, weights=counts)
         ax2.plot(self.sample_values, self.transformed_sample_values, color='r')
 
         ax1.set_xlabel('X data')
         ax2.set_ylabel('Transformed value')
-        ax1.set_ylabel('Count')
-        plt.title('Transformed plot of {}'.format(self.raster.name))
+        ax1.set_ylabel(self.count_label())
+        plt.title('Transformed plot of {}'.format(self.name))
         plt.show()
 
 
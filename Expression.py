@@ -0,0 +1,234 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import Jobs
+import Profiling
+from RasterStats import StatsAccumulator
+
+# Lazy, on-the-fly raster expressions. Nothing is read until evaluate() runs, which walks the
+# tiles once and computes every requested output per tile, so intermediates never hit disk.
+
+
+class ExpressionNode:
+    # numpy dtype the node output is rounded to, float32 mirrors a value stored in a F32 raster
+    dtype = None
+
+    def children(self):
+        return []
+
+    def compute(self, memo, tile):
+        # shared sub expressions are computed once per tile
+        key = id(self)
+        if key not in memo:
+            values = self._compute(memo, tile)
+            if self.dtype is not None:
+                values = values.astype(self.dtype).astype(np.float64)
+            memo[key] = values
+        return memo[key]
+
+    def _compute(self, memo, tile):
+        raise NotImplementedError
+
+    def nodes(self):
+        # every node of the graph, children before parents
+        seen, order = set(), []
+
+        def visit(node):
+            if id(node) in seen:
+                return
+            seen.add(id(node))
+            for child in node.children():
+                visit(child)
+            order.append(node)
+        visit(self)
+        return order
+
+
+class SourceNode(ExpressionNode):
+    def __init__(self, raster, backend):
+        self.raster = raster
+        self.backend = backend
+
+    def shape(self):
+        return self.backend.shape(self.raster)
+
+    def _compute(self, memo, tile):
+        # float32 or float64, possibly a read only view of the stored tile
+        return self.backend.read(self.raster, *tile)
+
+
+class MapNode(ExpressionNode):
+    # cell by cell function of one input array
+    def __init__(self, child, func, dtype=None):
+        self.child = child
+        self.func = func
+        self.dtype = dtype
+
+    def children(self):
+        return [self.child]
+
+    def _compute(self, memo, tile):
+        return self.func(np.asarray(self.child.compute(memo, tile), dtype=np.float64))
+
+
+class RescaleNode(ExpressionNode):
+    # linear stretch of the child onto [from_scale, to_scale], needs the child min and max first
+    def __init__(self, child, from_scale, to_scale, dtype=None):
+        self.child = child
+        self.from_scale = from_scale
+        self.to_scale = to_scale
+        self.dtype = dtype
+        self.minimum = None
+        self.maximum = None
+
+    def children(self):
+        return [self.child]
+
+    @property
+    def resolved(self):
+        return self.minimum is not None
+
+    def _compute(self, memo, tile):
+        if not self.resolved:
+            raise ValueError('RescaleNode has no min/max yet, call resolve() first')
+        v = np.asarray(self.child.compute(memo, tile), dtype=np.float64)
+        return (v - self.minimum) / (self.maximum - self.minimum) * (self.to_scale - self.from_scale) + \
+            self.from_scale
+
+
+class WeightedSumNode(ExpressionNode):
+    # NoData in any input gives NoData, like arcpy.sa.WeightedSum
+    def __init__(self, inputs, weights, dtype=None):
+        self.inputs = list(inputs)
+        self.weights = list(weights)
+        self.dtype = dtype
+
+    def children(self):
+        return self.inputs
+
+    def _compute(self, memo, tile):
+        total = np.zeros((tile[2], tile[3]))
+        for node, weight in zip(self.inputs, self.weights):
+            # float64 product straight from a float32 view, no upcast copy of the tile
+            total += np.multiply(node.compute(memo, tile), weight, dtype=np.float64)
+        return total
+
+
+class Output:
+    # where one evaluated expression goes: a raster, a statistics accumulator or both
+    def __init__(self, expression, raster=None, backend=None, stats=None):
+        self.expression = expression
+        self.raster = raster
+        self.backend = backend
+        self.stats = stats
+
+
+def graph_shape(expressions):
+    shapes = set()
+    for expression in expressions:
+        for node in expression.nodes():
+            if isinstance(node, SourceNode):
+                shapes.add(tuple(node.shape()))
+    if len(shapes) != 1:
+        raise ValueError('Expression inputs must share one raster shape, got {}'.format(sorted(shapes)))
+    return shapes.pop()
+
+
+def compute_tile(outputs, tile, memo=None):
+    # values and statistics of every output on one tile, safe to run in a worker thread
+    memo = {} if memo is None else memo
+    results = []
+    with np.errstate(all='ignore'):
+        for output in outputs:
+            # outputs are float32 rasters, statistics describe the stored values
+            values = output.expression.compute(memo, tile).astype(np.float32)
+            stats = None
+            if output.stats is not None:
+                stats = StatsAccumulator(output.stats.value_range, output.stats.n_bins)
+                stats.update(values)
+            results.append((values if output.raster is not None else None, stats))
+    return results
+
+
+def store_tile(outputs, tile, results):
+    # writes and statistics merges happen in the calling thread and in tile order,
+    # which keeps parallel results identical to a serial run
+    for output, (values, stats) in zip(outputs, results):
+        if values is not None:
+            output.backend.write(output.raster, values, tile[0], tile[1])
+            Profiling.count(bytes_written=values.nbytes)
+        if stats is not None:
+            output.stats.merge(stats)
+
+
+def schedule(expressions, config, task):
+    # yields (tile, task(tile, memo)) in tile order, tiles are computed on a thread pool when
+    # config.workers > 1 while the caller consumes results in order
+    nodes = {id(node): node for expression in expressions for node in expression.nodes()}
+    sources = [node for node in nodes.values() if isinstance(node, SourceNode)]
+    tiles = list(config.tiles(*graph_shape(expressions), n_arrays=len(nodes) + 1))
+    Jobs.start_pass(len(tiles))
+
+    def done(tile, memo):
+        Profiling.count(cells=tile[2] * tile[3],
+                        bytes_read=sum(memo[id(node)].nbytes for node in sources if id(node) in memo))
+        # progress of a background job, raises Jobs.Cancelled once it is cancelled
+        Jobs.tile_done()
+
+    if config.workers <= 1:
+        for tile in tiles:
+            memo = {}
+            result = task(tile, memo)
+            done(tile, memo)
+            yield tile, result
+        return
+
+    # backends that are not thread safe are read here and only the arithmetic runs in the pool
+    serial_sources = [node for node in sources if not getattr(node.backend, 'thread_safe', False)]
+    pending = deque()
+    with ThreadPoolExecutor(config.workers) as pool:
+        for tile in tiles:
+            memo = {id(node): node.compute({}, tile) for node in serial_sources}
+            pending.append((tile, memo, pool.submit(task, tile, memo)))
+            if len(pending) >= config.tiles_in_flight:
+                tile, memo, future = pending.popleft()
+                result = future.result()
+                done(tile, memo)
+                yield tile, result
+        while pending:
+            tile, memo, future = pending.popleft()
+            result = future.result()
+            done(tile, memo)
+            yield tile, result
+
+
+def evaluate(outputs, config):
+    expressions = [output.expression for output in outputs]
+    for tile, results in schedule(expressions, config, lambda tile, memo: compute_tile(outputs, tile, memo)):
+        store_tile(outputs, tile, results)
+
+
+def iter_values(expressions, config):
+    # float32 values of every expression, tile by tile
+    def task(tile, memo):
+        with np.errstate(all='ignore'):
+            return [expression.compute(memo, tile).astype(np.float32) for expression in expressions]
+    return schedule(expressions, config, task)
+
+
+def resolve(expressions, config):
+    # computes the min/max of every unresolved rescale, one pass per level of nesting
+    while True:
+        pending = [node for expression in expressions for node in expression.nodes()
+                   if isinstance(node, RescaleNode) and not node.resolved]
+        ready = [node for node in pending
+                 if not any(isinstance(child, RescaleNode) and not child.resolved
+                            for child in node.child.nodes())]
+        ready = list({id(node): node for node in ready}.values())
+        if not ready:
+            return
+        outputs = [Output(node.child, stats=StatsAccumulator()) for node in ready]
+        evaluate(outputs, config)
+        for node, output in zip(ready, outputs):
+            node.minimum = output.stats.minimum
+            node.maximum = output.stats.maximum
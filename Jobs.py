@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from concurrent.futures import CancelledError, Future
+
+# Background jobs for the notebook. A job runs in its own thread, the tile loops report progress to
+# the job of the calling thread and stop at the next tile once it is cancelled.
+
+# held by jobs reading backends that are not thread safe (arcpy), so they run one at a time
+SERIAL_LOCK = threading.Lock()
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+def start_pass(n_tiles):
+    job = getattr(_local, 'job', None)
+    if job is not None:
+        job.start_pass(n_tiles)
+
+
+def tile_done():
+    job = getattr(_local, 'job', None)
+    if job is not None:
+        job.tile_done()
+
+
+def check():
+    job = getattr(_local, 'job', None)
+    if job is not None:
+        job.check()
+
+
+class Job:
+    def __init__(self, name, on_progress=None):
+        self.name = name
+        # on_progress(job) after every tile, from the job thread
+        self.on_progress = on_progress
+        self.future = Future()
+        self.passes = 0
+        self.tiles_done = 0
+        # grows as each pass over the raster starts
+        self.tiles_total = 0
+        self._cancel = threading.Event()
+
+    def start(self, func, after=(), lock=None):
+        # runs func() in a new thread once the jobs in `after` finished, holding `lock` while it runs
+        def run():
+            if not self.future.set_running_or_notify_cancel():
+                return
+            _local.job = self
+            try:
+                for job in after:
+                    self.wait_for(job)
+                if lock is not None:
+                    with lock:
+                        result = func()
+                else:
+                    result = func()
+            except BaseException as e:
+                self.future.set_exception(e)
+            else:
+                self.future.set_result(result)
+            finally:
+                _local.job = None
+        threading.Thread(target=run, name=self.name, daemon=True).start()
+        return self
+
+    def wait_for(self, job):
+        # waits for another job, failing if it failed and staying responsive to cancel(). A cancelled
+        # job left its criterion or model as it was, so this one goes on
+        while not job.future.done():
+            self.check()
+            job._cancel.wait(0.05)
+        try:
+            job.future.result()
+        except (Cancelled, CancelledError):
+            if not job.cancelled():
+                raise
+
+    def start_pass(self, n_tiles):
+        self.check()
+        self.passes += 1
+        self.tiles_total += n_tiles
+
+    def tile_done(self):
+        self.tiles_done += 1
+        if self.on_progress is not None:
+            self.on_progress(self)
+        self.check()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise Cancelled('{} was cancelled'.format(self.name))
+
+    def cancel(self):
+        # stops the job at its next tile, the objects it works on keep their previous state
+        self._cancel.set()
+        self.future.cancel()
+
+    def progress(self):
+        return {'passes': self.passes, 'tiles_done': self.tiles_done, 'tiles_total': self.tiles_total}
+
+    def cancelled(self):
+        # True once the job stopped because of cancel(), a job that finished first is not cancelled
+        if self.future.cancelled():
+            return True
+        return self.future.done() and isinstance(self.future.exception(), Cancelled)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def add_done_callback(self, func):
+        self.future.add_done_callback(lambda future: func(self))
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def __repr__(self):
+        state = 'cancelled' if self.cancelled() else 'done' if self.done() else 'running'
+        return '<Job {} {} {tiles_done}/{tiles_total} tiles>'.format(self.name, state, **self.progress())
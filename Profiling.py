@@ -0,0 +1,77 @@
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Per stage timings and counters. The tile loops report cells and bytes through count(), which adds
+# them to every stage open in the calling thread. With no stage open count() is one attribute lookup.
+
+COUNTERS = ('cells', 'bytes_read', 'bytes_written', 'cache_hits', 'cache_misses')
+
+_local = threading.local()
+
+
+def count(**counters):
+    # nested stages include the counts of the stages inside them, like their times
+    records = getattr(_local, 'records', None)
+    if records:
+        for record in records:
+            for key, value in counters.items():
+                record[key] += value
+
+
+class Profiler:
+    def __init__(self, hooks=()):
+        # hook(stage, record) is called when a stage closes, record holds that call's measurements
+        self.hooks = list(hooks)
+        self.totals = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name):
+        record = dict.fromkeys(COUNTERS, 0)
+        if getattr(_local, 'records', None) is None:
+            _local.records = []
+        _local.records.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            _local.records.pop()
+            total = self.totals.setdefault(name, dict(dict.fromkeys(COUNTERS, 0), seconds=0.0, calls=0))
+            for key in COUNTERS + ('seconds',):
+                total[key] += record[key]
+            total['calls'] += 1
+            for hook in self.hooks:
+                hook(name, record)
+
+    def summary(self):
+        # totals per stage in the order the stages first ran
+        return {name: dict(total) for name, total in self.totals.items()}
+
+    def reset(self):
+        self.totals = {}
+
+    def report(self):
+        print('{:<22}{:>6}{:>11}{:>14}{:>12}{:>12}{:>6}{:>6}'.format(
+            'stage', 'calls', 'seconds', 'cells', 'MB read', 'MB written', 'hits', 'miss'))
+        for name, total in self.totals.items():
+            print('{:<22}{:>6}{:>11.3f}{:>14}{:>12.1f}{:>12.1f}{:>6}{:>6}'.format(
+                name, total['calls'], total['seconds'], total['cells'], total['bytes_read'] / 1024 ** 2,
+                total['bytes_written'] / 1024 ** 2, total['cache_hits'], total['cache_misses']))
+
+
+class NullProfiler:
+    # default of Criteria and SuitabilityModel, every stage is the same no-op context manager
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def summary(self):
+        return {}
+
+
+NULL_PROFILER = NullProfiler()
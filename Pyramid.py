@@ -0,0 +1,33 @@
+import numpy as np
+import Profiling
+from RasterBackend import NumpyRaster
+
+
+def level_shape(height, width, level):
+    # level k keeps the centre cell of every 2**k by 2**k block, partial blocks at the edges included
+    step = 2 ** level
+    return len(range(step // 2, height, step)), len(range(step // 2, width, step))
+
+
+def build_level(backend, raster, config, level):
+    # overview `level` from one pass over the source, the other levels are not built. Cells are picked,
+    # not averaged, so categorical rasters keep their classes and every overview cell is a source value,
+    # stored as float32 like the transformed rasters
+    height, width = backend.shape(raster)
+    step = 2 ** level
+    data = np.full(level_shape(height, width, level), np.nan, dtype=np.float32)
+    for row, col, nrows, ncols in config.tiles(height, width):
+        # first row and column of the tile that lands on the level grid
+        r0, c0 = (step // 2 - row) % step, (step // 2 - col) % step
+        if r0 >= nrows or c0 >= ncols:
+            continue
+        values = backend.read(raster, row, col, nrows, ncols)
+        Profiling.count(cells=nrows * ncols, bytes_read=values.nbytes)
+        block = values[r0::step, c0::step]
+        data[(row + r0) // step:(row + r0) // step + block.shape[0],
+             (col + c0) // step:(col + c0) // step + block.shape[1]] = block
+    x0, dx, rx, y0, ry, dy = getattr(raster, 'transform', (0, 1, 0, 0, 0, -1))
+    # a level cell covers a step by step block of source cells, the grid origin is unchanged
+    return NumpyRaster(data, transform=(x0, dx * step, rx * step, y0, ry * step, dy * step),
+                       name='{}_level{}'.format(backend.name(raster), level),
+                       spatial_reference=getattr(raster, 'spatial_reference', None))
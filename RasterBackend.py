@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import numpy as np
+from Tiling import TileConfig, accumulate_raster
+from TiledRaster import TiledRaster, TiledBackend
+from CompactRaster import CompactRaster, CompactBackend
+
+try:
+    import arcpy
+except ImportError:
+    # arcpy is only available on ArcGIS machines, the NumPy backend works without it
+    arcpy = None
+
+
+def dataset_signature(path):
+    # newest modification time, total size and number of the files of a dataset. A GRID raster is a
+    # folder and a geodatabase raster lives inside the .gdb folder, whose own modification time does
+    # not change when the files in it are edited in place, so the files are listed. A raster file
+    # counts with its sidecars (.aux.xml, .ovr, ...)
+    existing = path
+    while existing and not os.path.exists(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    files = []
+    if existing and os.path.isdir(existing):
+        for root, _, names in os.walk(existing):
+            files.extend(os.path.join(root, name) for name in names)
+    elif existing and os.path.exists(existing):
+        folder, base = os.path.split(existing)
+        files = [os.path.join(folder, name) for name in os.listdir(folder) if name.startswith(base)]
+    mtime, size, count = None, 0, 0
+    for name in files:
+        try:
+            stat = os.stat(name)
+        except OSError:
+            # removed while listing, e.g. a lock file
+            continue
+        mtime = stat.st_mtime if mtime is None else max(mtime, stat.st_mtime)
+        size += stat.st_size
+        count += 1
+    return {'mtime': mtime, 'size': size, 'files': count}
+
+
+class ArcpyBackend:
+    # arcpy raster objects are read from the calling thread only
+    thread_safe = False
+
+    def __init__(self):
+        if arcpy is None:
+            raise ImportError('arcpy is required for the ArcpyBackend, use NumpyRaster inputs instead')
+        arcpy.CheckOutExtension("Spatial")
+
+    def shape(self, raster):
+        return raster.height, raster.width
+
+    def name(self, raster):
+        return raster.name
+
+    def read(self, raster, row, col, nrows, ncols):
+        block = raster.read(upper_left_corner=(col, row), ncols=ncols, nrows=nrows).reshape(nrows, ncols)
+        # compute in double precision like the per-cell math module calls did
+        values = block.astype(np.float64)
+        if raster.noDataValue is not None:
+            values[block == raster.noDataValue] = np.nan
+        return values
+
+    def write(self, raster, values, row, col):
+        nrows, ncols = values.shape
+        raster.write(values.astype(np.float32).reshape(nrows, ncols, 1), upper_left_corner=(col, row))
+
+    def create_like(self, raster):
+        raster_info = raster.getRasterInfo()
+        raster_info.setPixelType('F32')
+        return arcpy.Raster(raster_info)
+
+    def identity(self, raster):
+        # dataset path plus the newest modification time and total size of the files holding it
+        return dict(dataset_signature(raster.catalogPath), path=raster.catalogPath)
+
+    def calculate_statistics(self, raster):
+        arcpy.CalculateStatistics_management(raster)
+
+    def set_statistics(self, raster, stats):
+        # arcpy keeps its own statistics for rendering, so let it compute them
+        arcpy.CalculateStatistics_management(raster)
+
+    def statistics(self, raster):
+        return {'min': raster.minimum, 'max': raster.maximum,
+                'mean': raster.mean, 'std': raster.standardDeviation}
+
+
+class NumpyRaster:
+    # GDAL style affine transform (x_origin, cell_width, row_rotation, y_origin, col_rotation, -cell_height)
+    def __init__(self, data, mask=None, transform=(0, 1, 0, 0, 0, -1), name='raster', spatial_reference=None):
+        self.data = np.asarray(data)
+        if self.data.ndim != 2:
+            raise ValueError('NumpyRaster expects a 2D array, got shape {}'.format(self.data.shape))
+        # True where the cell is NoData, NaN cells of float rasters are NoData as well
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.transform = tuple(transform)
+        self.name = name
+        self.spatial_reference = spatial_reference
+        self.stats = None
+        # file the raster was loaded from, None for arrays built in memory
+        self.path = None
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    @property
+    def cell_size(self):
+        return abs(self.transform[1]), abs(self.transform[5])
+
+    @property
+    def extent(self):
+        # (x_min, y_min, x_max, y_max) of a north up raster
+        x0, dx, _, y0, _, dy = self.transform
+        xs = (x0, x0 + dx * self.width)
+        ys = (y0, y0 + dy * self.height)
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def save(self, path):
+        meta = {'transform': self.transform, 'name': self.name, 'spatial_reference': self.spatial_reference}
+        arrays = {'data': self.data, 'meta': np.array(json.dumps(meta))}
+        if self.mask is not None:
+            arrays['mask'] = self.mask
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            mask = f['mask'] if 'mask' in f else None
+            raster = cls(f['data'], mask, meta['transform'], meta['name'], meta['spatial_reference'])
+        raster.path = os.path.abspath(path)
+        return raster
+
+
+class NumpyBackend:
+    # reads of disjoint tiles can run in worker threads
+    thread_safe = True
+
+    def shape(self, raster):
+        return raster.height, raster.width
+
+    def name(self, raster):
+        return raster.name
+
+    def read(self, raster, row, col, nrows, ncols):
+        if raster.mask is None and np.issubdtype(raster.data.dtype, np.floating):
+            # NaN already marks NoData, hand out a view instead of a copy
+            return raster.data[row:row + nrows, col:col + ncols]
+        values = raster.data[row:row + nrows, col:col + ncols].astype(np.float64)
+        if raster.mask is not None:
+            values[raster.mask[row:row + nrows, col:col + ncols]] = np.nan
+        return values
+
+    def write(self, raster, values, row, col):
+        nrows, ncols = values.shape
+        raster.data[row:row + nrows, col:col + ncols] = values
+        if raster.mask is not None:
+            raster.mask[row:row + nrows, col:col + ncols] = np.isnan(values)
+        raster.stats = None
+
+    def create_like(self, raster):
+        return NumpyRaster(np.full((raster.height, raster.width), np.nan, dtype=np.float32),
+                           transform=raster.transform, name=raster.name,
+                           spatial_reference=raster.spatial_reference)
+
+    def identity(self, raster):
+        if raster.path is not None:
+            return {'path': raster.path, 'mtime': os.path.getmtime(raster.path)}
+        # in memory arrays are identified by their content
+        digest = hashlib.sha256(np.ascontiguousarray(raster.data).data)
+        if raster.mask is not None:
+            digest.update(np.ascontiguousarray(raster.mask).data)
+        return {'sha256': digest.hexdigest(), 'dtype': str(raster.data.dtype), 'shape': raster.data.shape,
+                'transform': raster.transform}
+
+    def calculate_statistics(self, raster):
+        raster.stats = accumulate_raster(self, raster, TileConfig()).as_dict()
+
+    def set_statistics(self, raster, stats):
+        # statistics already accumulated while the raster was written
+        raster.stats = stats.as_dict()
+
+    def statistics(self, raster):
+        if raster.stats is None:
+            self.calculate_statistics(raster)
+        return raster.stats
+
+
+def get_backend(raster):
+    if isinstance(raster, NumpyRaster):
+        return NumpyBackend()
+    if isinstance(raster, TiledRaster):
+        return TiledBackend()
+    if isinstance(raster, CompactRaster):
+        return CompactBackend()
+    return ArcpyBackend()
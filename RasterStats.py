@@ -0,0 +1,166 @@
+import numpy as np
+
+# fine bins kept by the accumulator, plots re-bin them to the requested bin count
+HISTOGRAM_BINS = 1000
+
+
+class StatsAccumulator:
+    # one pass, mergeable statistics over the valid (non NaN) cells of a raster
+    def __init__(self, value_range=None, n_bins=HISTOGRAM_BINS):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        # the histogram needs a fixed range known up front so partial results can be merged
+        self.value_range = None if value_range is None else (float(value_range[0]), float(value_range[1]))
+        self.n_bins = n_bins
+        self.counts = None if value_range is None else np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        n = values.size
+        tile_mean = values.mean()
+        tile_m2 = ((values - tile_mean) ** 2).sum()
+        self._combine(n, tile_mean, tile_m2, values.min(), values.max())
+        if self.counts is not None:
+            self.counts += np.bincount(self._bin_index(values), minlength=self.counts.size)
+        return self
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.counts is not None:
+            if other.counts is None or other.value_range != self.value_range or \
+                    other.counts.size != self.counts.size:
+                raise ValueError('Cannot merge histograms with different ranges or bin counts')
+            self.counts += other.counts
+        self._combine(other.count, other.mean, other.m2, other.minimum, other.maximum)
+        return self
+
+    def _combine(self, n, mean, m2, minimum, maximum):
+        # Chan et al. pairwise update of the Welford mean and sum of squared deviations
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        self.minimum = min(self.minimum, float(minimum))
+        self.maximum = max(self.maximum, float(maximum))
+
+    def _bin_index(self, values):
+        lo, hi = self.value_range
+        n_bins = self.counts.size
+        if hi == lo:
+            return np.zeros(values.size, dtype=np.intp)
+        idx = ((values - lo) * (n_bins / (hi - lo))).astype(np.intp)
+        return np.clip(idx, 0, n_bins - 1)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance)) if self.count else None
+
+    def as_dict(self):
+        if self.count == 0:
+            return {'min': None, 'max': None, 'mean': None, 'std': None, 'count': 0}
+        return {'min': self.minimum, 'max': self.maximum, 'mean': float(self.mean),
+                'std': self.std, 'count': self.count}
+
+    def state(self):
+        # plain scalars plus the histogram counts, enough to rebuild the accumulator later
+        return {'count': self.count, 'mean': float(self.mean), 'm2': float(self.m2),
+                'minimum': float(self.minimum), 'maximum': float(self.maximum),
+                'value_range': self.value_range, 'n_bins': self.n_bins}, self.counts
+
+    @classmethod
+    def from_state(cls, state, counts=None):
+        stats = cls(state['value_range'], state['n_bins'])
+        stats.count, stats.mean, stats.m2 = state['count'], state['mean'], state['m2']
+        stats.minimum, stats.maximum = state['minimum'], state['maximum']
+        if counts is not None:
+            stats.counts = np.array(counts, dtype=np.int64)
+        return stats
+
+    def fine_edges(self):
+        return np.linspace(self.value_range[0], self.value_range[1], self.counts.size + 1)
+
+    def histogram(self, n_bins=20):
+        # re-bins the fine histogram onto n_bins equal bins between the observed min and max,
+        # each fine bin goes to the bin holding its centre so edges are exact to one fine bin
+        if self.counts is None:
+            raise ValueError('Histogram was not accumulated, pass a value_range to StatsAccumulator')
+        edges = np.histogram_bin_edges([], bins=n_bins, range=(self.minimum, self.maximum)) \
+            if self.count else np.linspace(0, 1, n_bins + 1)
+        fine = self.fine_edges()
+        centres = (fine[:-1] + fine[1:]) / 2
+        idx = np.clip(np.searchsorted(edges, centres, side='right') - 1, 0, n_bins - 1)
+        return np.bincount(idx, weights=self.counts, minlength=n_bins).astype(np.int64), edges
+
+    def quantile(self, q):
+        # approximate, linear interpolation inside the fine bin holding the q-th value
+        if self.counts is None or self.count == 0:
+            return None
+        qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        cumulative = np.cumsum(self.counts)
+        fine = self.fine_edges()
+        result = []
+        for p in qs:
+            target = p * self.count
+            i = min(int(np.searchsorted(cumulative, target, side='left')), self.counts.size - 1)
+            before = cumulative[i - 1] if i > 0 else 0
+            frac = (target - before) / self.counts[i] if self.counts[i] else 0.0
+            value = fine[i] + frac * (fine[i + 1] - fine[i])
+            result.append(min(max(value, self.minimum), self.maximum))
+        return result[0] if np.ndim(q) == 0 else np.array(result)
+
+
+def sampling_error(stats, fraction, confidence=0.95):
+    # how far statistics of a sample holding `fraction` of the cells may be from the full raster,
+    # treating the sample as random: standard errors of the mean and std with the finite population
+    # correction, and the DKW bound on the largest error of any cumulative histogram count share
+    if stats.count < 2:
+        return None
+    correction = np.sqrt(max(1.0 - fraction, 0.0))
+    return {'sample_cells': stats.count, 'fraction': fraction,
+            'mean_stderr': float(stats.std / np.sqrt(stats.count) * correction),
+            'std_stderr': float(stats.std / np.sqrt(2.0 * (stats.count - 1)) * correction),
+            'cdf_bound': float(np.sqrt(np.log(2.0 / (1.0 - confidence)) / (2.0 * stats.count)) * correction),
+            'confidence': confidence}
+
+
+def update_rows(accumulators, block):
+    # accumulators[i].update(block[i]) for a NaN free 2D block, vectorized over the rows
+    n = block.shape[1]
+    if n == 0:
+        return
+    block = np.asarray(block, dtype=np.float64)
+    means = block.mean(axis=1)
+    m2 = ((block - means[:, None]) ** 2).sum(axis=1)
+    minima, maxima = block.min(axis=1), block.max(axis=1)
+    for i, stats in enumerate(accumulators):
+        stats._combine(n, means[i], m2[i], minima[i], maxima[i])
+    rows = [i for i, stats in enumerate(accumulators) if stats.counts is not None]
+    if not rows:
+        return
+    n_bins = accumulators[rows[0]].counts.size
+    if any(accumulators[i].counts.size != n_bins for i in rows):
+        for i in rows:
+            accumulators[i].counts += np.bincount(accumulators[i]._bin_index(block[i]), minlength=n_bins)
+        return
+    # same arithmetic as _bin_index, with the range of each row broadcast down the columns
+    lo = np.array([accumulators[i].value_range[0] for i in rows])
+    hi = np.array([accumulators[i].value_range[1] for i in rows])
+    flat = hi == lo
+    scale = np.where(flat, 0.0, n_bins / np.where(flat, 1.0, hi - lo))
+    idx = np.clip(((block[rows] - lo[:, None]) * scale[:, None]).astype(np.intp), 0, n_bins - 1)
+    idx += np.arange(len(rows))[:, None] * n_bins
+    counts = np.bincount(idx.ravel(), minlength=len(rows) * n_bins).reshape(len(rows), n_bins)
+    for i, row_counts in zip(rows, counts):
+        accumulators[i].counts += row_counts
@@ -0,0 +1,54 @@
+import numpy as np
+
+# widest integer key span compiled into a dense lookup table, wider tables fall back to a sorted search
+MAX_LUT_SIZE = 1 << 20
+
+
+class UniqueRemap:
+    # 'unique' remap compiled once: cells equal to a key get its value, every other cell is NoData
+    def __init__(self, remap):
+        keys = np.array([float(k) for k in remap.keys()])
+        values = np.array([float(v) for v in remap.values()])
+        integral = keys.size > 0 and np.all(np.isfinite(keys)) and np.all(keys == np.floor(keys))
+        if integral and keys.max() - keys.min() < MAX_LUT_SIZE:
+            self.offset = keys.min()
+            self.lut = np.full(int(keys.max() - self.offset) + 1, np.nan)
+            self.lut[(keys - self.offset).astype(np.intp)] = values
+        else:
+            self.lut = None
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.values = values[order]
+
+    def __call__(self, v):
+        out = np.full(v.shape, np.nan)
+        if self.lut is not None:
+            idx = v - self.offset
+            # NaN and non integer cells never match, like a dict lookup
+            hit = (idx >= 0) & (idx < self.lut.size) & (v == np.floor(v))
+            out[hit] = self.lut[idx[hit].astype(np.intp)]
+        elif self.keys.size:
+            pos = np.minimum(np.searchsorted(self.keys, v), self.keys.size - 1)
+            hit = self.keys[pos] == v
+            out[hit] = self.values[pos[hit]]
+        return out
+
+
+class RangeRemap:
+    # 'range' remap compiled into sorted breakpoints: every cell in (s, e] gets the value of the
+    # last such interval in dict order, cells outside all intervals are NoData
+    def __init__(self, remap):
+        items = [((float(s), float(e)), float(value)) for (s, e), value in remap.items()]
+        self.bounds = np.unique([bound for (s, e), _ in items for bound in (s, e)])
+        # table[i] holds the value of the elementary interval (bounds[i - 1], bounds[i]], the first
+        # and last entries catch cells below and above every interval
+        self.table = np.full(self.bounds.size + 1, np.nan)
+        for i in range(1, self.bounds.size):
+            lo, hi = self.bounds[i - 1], self.bounds[i]
+            for (s, e), value in items:
+                if s <= lo and hi <= e:
+                    self.table[i] = value
+
+    def __call__(self, v):
+        # side='left' gives bounds[i - 1] < v <= bounds[i], NaN sorts past the end
+        return self.table[np.searchsorted(self.bounds, v, side='left')]
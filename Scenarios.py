@@ -0,0 +1,119 @@
+import os
+import Profiling
+from SuitabilityModel import *
+
+# bytes of float64 scenario outputs computed at once, scenarios are processed in chunks of this size
+# so the temporaries stay in cache
+BATCH_BYTES = 1 << 22
+
+
+class ScenarioResults:
+    def __init__(self, weights, stats, maps):
+        # effective weights, one row per scenario and one column per batch column
+        self.weights = weights
+        self.stats = stats
+        # scenario index -> (raster, backend) for the scenarios asked for with maps=
+        self.maps = maps
+
+    def summary(self):
+        return [stats.as_dict() for stats in self.stats]
+
+
+class ScenarioBatch:
+    # many weightings of the same criteria evaluated in one pass: every tile is read once and all
+    # scenario outputs are a weights x criteria matrix product on the stacked tile
+    def __init__(self, model):
+        self.model = model
+        # the model criteria first, then variants added with add_variant()
+        self.columns = list(model.criteria)
+
+    def add_variant(self, index, type, params):
+        # criterion `index` with other transform params as an extra column, returns its column index
+        self.columns.append(self.model.criteria[index].variant(type, params))
+        return len(self.columns) - 1
+
+    def effective_weights(self, weights):
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        if weights.shape[1] != len(self.columns):
+            raise ValueError('Expected {} weights per scenario, got {}'.format(len(self.columns), weights.shape[1]))
+        return weights if self.model.weight_method == 'multiplier' else weights / 100
+
+    def output_range(self, weights):
+        lo, hi = 0.0, 0.0
+        for column, weight in zip(self.columns, weights):
+            if weight != 0:
+                ends = [weight * v for v in column.value_range()]
+                lo += min(ends)
+                hi += max(ends)
+        return lo, hi
+
+    def run(self, weights, maps=(), archive=None, quantize=None):
+        # weights in the units of the model, one row per scenario. NoData in any model criterion gives
+        # NoData like the model, a variant with a zero weight is left out of that scenario.
+        # With an archive folder the maps are written there as compressed scenario_<i> rasters,
+        # quantized over the scenario output range when quantize is 'uint8' or 'uint16'
+        weights = self.effective_weights(weights)
+        stats = [StatsAccumulator(self.output_range(row)) for row in weights]
+        if archive is None:
+            rasters = {i: self.model.new_map() for i in maps}
+        else:
+            rasters = {i: (self.archive_map(archive, i, quantize, stats[i].value_range), CompactBackend())
+                       for i in maps}
+        # scenarios weighting the same columns share their valid cells. The model criteria always
+        # count for NoData like in calculate(), a variant only in the scenarios that weight it
+        criteria = np.arange(len(self.columns)) < len(self.model.criteria)
+        groups = {}
+        for i, row in enumerate(weights):
+            groups.setdefault(tuple((row != 0) | criteria), []).append(i)
+        groups = [(np.array(used), np.array(rows)) for used, rows in groups.items()]
+        expressions = [column.expression for column in self.columns]
+
+        def task(tile, memo):
+            return self.compute_tile(expressions, weights, groups, stats, rasters, tile, memo)
+
+        with self.model.profiler.stage('scenarios'):
+            for tile, results in schedule(expressions, self.model.tile_config, task):
+                for i, (values, tile_stats) in enumerate(results):
+                    stats[i].merge(tile_stats)
+                    if values is not None:
+                        raster, backend = rasters[i]
+                        backend.write(raster, values, tile[0], tile[1])
+                        Profiling.count(bytes_written=values.nbytes)
+        for i, (raster, backend) in rasters.items():
+            backend.set_statistics(raster, stats[i])
+            if archive is not None:
+                raster.close()
+        return ScenarioResults(weights, stats, rasters)
+
+    def archive_map(self, archive, index, quantize, value_range):
+        like, backend = self.model.criteria[0].input_raster()
+        os.makedirs(archive, exist_ok=True)
+        return CompactRaster.create(os.path.join(archive, 'scenario_{:05d}'.format(index)), backend.shape(like),
+                                    quantize, value_range, transform=getattr(like, 'transform', (0, 1, 0, 0, 0, -1)),
+                                    name='scenario_{:05d}'.format(index),
+                                    spatial_reference=getattr(like, 'spatial_reference', None))
+
+    def compute_tile(self, expressions, weights, groups, stats, rasters, tile, memo):
+        nrows, ncols = tile[2], tile[3]
+        results = [None] * weights.shape[0]
+        with np.errstate(all='ignore'):
+            stack = np.stack([np.asarray(e.compute(memo, tile), dtype=np.float64).ravel() for e in expressions])
+            missing = np.isnan(stack)
+            for used, rows in groups:
+                valid = ~missing[used].any(axis=0)
+                cells = stack[used][:, valid]
+                chunk = max(1, BATCH_BYTES // (8 * max(cells.shape[1], 1)))
+                for start in range(0, rows.size, chunk):
+                    part = rows[start:start + chunk]
+                    # rounded to float32 like compute_tile()
+                    block = (weights[part][:, used] @ cells).astype(np.float32)
+                    tile_stats = [StatsAccumulator(stats[i].value_range, stats[i].n_bins) for i in part]
+                    update_rows(tile_stats, block)
+                    for i, values, accumulator in zip(part, block, tile_stats):
+                        out = None
+                        if i in rasters:
+                            out = np.full(nrows * ncols, np.nan, dtype=np.float32)
+                            out[valid] = values
+                            out = out.reshape(nrows, ncols)
+                        results[i] = (out, accumulator)
+        return results
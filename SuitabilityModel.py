@@ -1,45 +1,437 @@
+import tempfile
+import time
+import Profiling
 from Criteria import *
 
 
+# cells updated per chunk by the incremental weight updates, bounds the temporaries
+UPDATE_CHUNK = 1 << 20
+
+
+class InteractiveCache:
+    # scaled criterion values over the cells valid in every criterion, kept in memory so a weight
+    # change only costs output += delta_w * criterion instead of a full recalculation
+    def __init__(self, criteria, weights, config):
+        self.config = config
+        # (criterion, version, expression) the columns were read from
+        self.inputs = [(criterion, criterion.version, criterion.expression) for criterion in criteria]
+        self.tiles = []
+        self.masks = []
+        self.offsets = [0]
+        n = len(criteria)
+        chunks = [[] for _ in range(n)]
+        # moments of the criteria over the common valid cells, merged per tile like StatsAccumulator
+        self.count = 0
+        self.means = np.zeros(n)
+        self.cov = np.zeros((n, n))
+        for tile, values in iter_values([criterion.expression for criterion in criteria], config):
+            stack = np.stack(values)
+            valid = ~np.isnan(stack).any(axis=0)
+            block = stack[:, valid]
+            for i in range(n):
+                chunks[i].append(block[i])
+            self.tiles.append(tile)
+            self.masks.append(valid)
+            self.offsets.append(self.offsets[-1] + block.shape[1])
+            self._merge_moments(block.astype(np.float64))
+        self.columns = [np.concatenate(c) if c else np.zeros(0, dtype=np.float32) for c in chunks]
+        self.weights = [0.0] * n
+        # float64 so repeated incremental updates do not drift
+        self.output = np.zeros(self.offsets[-1])
+        for i, weight in enumerate(weights):
+            self.set_weight(i, weight)
+
+    def stale(self, criteria):
+        # True once a criterion was added, removed or transformed again since the columns were read
+        return len(criteria) != len(self.inputs) or \
+            any(criterion is not old or criterion.version != version or criterion.expression is not expression
+                for criterion, (old, version, expression) in zip(criteria, self.inputs))
+
+    def _merge_moments(self, block):
+        n = block.shape[1]
+        if n == 0:
+            return
+        tile_mean = block.mean(axis=1)
+        centred = block - tile_mean[:, None]
+        total = self.count + n
+        delta = tile_mean - self.means
+        self.cov += centred @ centred.T + np.outer(delta, delta) * self.count * n / total
+        self.means += delta * n / total
+        self.count = total
+
+    def set_weight(self, index, weight):
+        delta = np.float64(weight - self.weights[index])
+        column = self.columns[index]
+        for start in range(0, column.size, UPDATE_CHUNK):
+            self.output[start:start + UPDATE_CHUNK] += column[start:start + UPDATE_CHUNK] * delta
+        self.weights[index] = weight
+
+    def moments(self):
+        # exact mean and standard deviation of the weighted sum without touching the cells
+        if self.count == 0:
+            return None, None
+        w = np.asarray(self.weights, dtype=np.float64)
+        return float(w @ self.means), float(np.sqrt(max(w @ self.cov @ w / self.count, 0.0)))
+
+    def output_stats(self, value_range):
+        # per tile accumulators merged in tile order, same as a full calculate()
+        stats = StatsAccumulator(value_range)
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            stats.merge(StatsAccumulator(value_range).update(self.output[start:end].astype(np.float32)))
+        return stats
+
+    def write(self, backend, raster):
+        for tile, valid, start, end in zip(self.tiles, self.masks, self.offsets[:-1], self.offsets[1:]):
+            values = np.full(valid.shape, np.nan, dtype=np.float32)
+            values[valid] = self.output[start:end]
+            backend.write(raster, values, tile[0], tile[1])
+            Profiling.count(bytes_written=values.nbytes)
+
+
+class ContributionState:
+    # float64 weighted sum with NoData inputs counted instead of propagated, so the contribution of
+    # one criterion can be swapped later without reading the others. Kept in temporary memory maps,
+    # 10 bytes per cell, once the model is recalculated after a change
+    def __init__(self, shape, inputs):
+        self.shape = shape
+        self.total = np.memmap(tempfile.TemporaryFile(), dtype=np.float64, mode='w+', shape=shape)
+        self.missing = np.memmap(tempfile.TemporaryFile(), dtype=np.uint16, mode='w+', shape=shape)
+        # (criterion, version, expression, weight) of every input the sums were taken with
+        self.inputs = inputs
+
+    def changed(self, inputs, shape):
+        return changed_inputs(self.inputs, inputs) if shape == self.shape else None
+
+
+def changed_inputs(previous, inputs):
+    # indices of the inputs whose transform or weight changed, None when the criteria differ
+    if previous is None or len(inputs) != len(previous) or \
+            any(old[0] is not new[0] for old, new in zip(previous, inputs)):
+        return None
+    return [i for i, (old, new) in enumerate(zip(previous, inputs)) if old[1] != new[1] or old[3] != new[3]]
+
+
+def add_contribution(total, missing, values, weight, sign=1):
+    # same float64 product as WeightedSumNode, NoData cells add nothing and are counted instead
+    nodata = np.isnan(values)
+    product = np.multiply(np.where(nodata, 0.0, values), weight, dtype=np.float64)
+    if sign > 0:
+        total += product
+        missing += nodata
+    else:
+        total -= product
+        missing -= nodata
+
+
 class SuitabilityModel:
-    def __init__(self, weight_method='multiplier', from_scale=1, to_scale=10):
+    def __init__(self, weight_method='multiplier', from_scale=1, to_scale=10, tile_config=None, backend=None,
+                 profiler=None):
         self.criteria = []
         self.weight = []
         self.weight_method = weight_method
-        self.suitability_values = []
         self.from_scale = from_scale
         self.to_scale = to_scale
-        self.suitability_map = None
-        arcpy.CheckOutExtension("Spatial")
+        self.tile_config = tile_config if tile_config is not None else TileConfig()
+        # defaults to the backend of the first criterion
+        self.backend = backend
+        # set by cache_criteria(), makes set_weight() incremental
+        self.cache = None
+        self._suitability_map = None
+        self._suitability_stats = None
+        self._map_stale = False
+        # backend of the suitability map, NumPy for preview maps whatever the criteria use
+        self._map_backend = None
+        # weighted sum kept by recalculations, lets the next one recompute only the changed criteria
+        self._state = None
+        # (shape, inputs) of the last calculate()
+        self._inputs = None
+        self.last_calculation = None
+        # last Job started by calculate_async()
+        self.job = None
+        # optional Profiler, pass the same one to the criteria to see their stages next to the model's
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
 
     def add_criteria(self, criterion, weight=1):
         self.criteria.append(criterion)
         self.weight.append(weight)
+        self.cache = None
 
-    def calculate(self):
-        raster_weight_list = []
+    def effective_weights(self):
+        if self.weight_method == 'multiplier':
+            return list(self.weight)
+        return [w / 100 for w in self.weight]
 
-        for i in range(len(self.criteria)):
-            if self.weight_method == 'multiplier':
-                raster_weight_list.append([self.criteria[i].transformed_raster, 'VALUE', self.weight[i]])
+    @property
+    def suitability_map(self):
+        self._drop_stale_cache()
+        if self._map_stale:
+            # re-weighted in the cache since the map was last written
+            with self.profiler.stage('write_map'):
+                self.cache.write(self._map_backend, self._suitability_map)
+                self._map_backend.set_statistics(self._suitability_map, self.suitability_stats)
+            self._map_stale = False
+        return self._suitability_map
+
+    @property
+    def suitability_stats(self):
+        self._drop_stale_cache()
+        if self._suitability_stats is None and self.cache is not None:
+            with self.profiler.stage('output_stats'):
+                self._suitability_stats = self.cache.output_stats(self.output_range(self.effective_weights()))
+        return self._suitability_stats
+
+    def _drop_stale_cache(self):
+        # the cached columns no longer match the criteria, or add_criteria() dropped them before the
+        # re-weighted map was written: recalculate with the current weights
+        if self.cache is None and self._map_stale or self.cache is not None and self.cache.stale(self.criteria):
+            self.cache = None
+            self.calculate()
+
+    def calculate(self, full=False):
+        # the first run and full=True write only the map. A run after a change also keeps the float64
+        # weighted sum, from then on only criteria whose transform or weight changed are read, their
+        # old contribution is taken out of the kept sum and the new one added
+        with self.profiler.stage('calculate'):
+            self._calculate(full)
+
+    def _calculate(self, full=False):
+        weights = self.effective_weights()
+        if self.backend is None:
+            self.backend = self.criteria[0].backend
+        inputs = [(criterion, criterion.version, criterion.expression, weight)
+                  for criterion, weight in zip(self.criteria, weights)]
+        shape = graph_shape([criterion.expression for criterion in self.criteria])
+        last = None if self._inputs is None or self._inputs[0] != shape else self._inputs[1]
+        if not full and changed_inputs(last, inputs) == [] and self._suitability_map is not None and \
+                not self._map_stale:
+            self.last_calculation = {'mode': 'unchanged', 'criteria': []}
+            return
+        changed = None if full or self._state is None else self._state.changed(inputs, shape)
+        if changed and len(changed) < len(inputs):
+            self.last_calculation = {'mode': 'delta', 'criteria': changed}
+            self._sum_pass(inputs, shape, changed, self._state)
+        else:
+            self.last_calculation = {'mode': 'full', 'criteria': list(range(len(inputs)))}
+            if full or self._inputs is None:
+                self._fused_pass(inputs)
             else:
-                raster_weight_list.append([self.criteria[i].transformed_raster, 'VALUE', self.weight[i]/ 100])
-        WSumTableObj  = arcpy.sa.WSTable(raster_weight_list)
-        self.suitability_map = arcpy.sa.WeightedSum(WSumTableObj)
+                # the model is being edited, the weighted sum is kept from now on so the next change
+                # only reads the criteria it touches
+                self._sum_pass(inputs, shape, list(range(len(inputs))), None)
+        self._inputs = (shape, inputs)
+
+    def _stats_outputs(self, indices):
+        # criteria statistics not computed yet come for free in the same pass
+        return [Output(self.criteria[i].expression, stats=StatsAccumulator(self.criteria[i].value_range()))
+                for i in indices if self.criteria[i]._transformed_stats is None]
+
+    def _store_stats_outputs(self, outputs):
+        for output in outputs:
+            for criterion in self.criteria:
+                if criterion.expression is output.expression:
+                    criterion._transformed_stats = output.stats
+
+    def _replace_map(self, suitability_map, backend, stats):
+        Jobs.check()
+        backend.set_statistics(suitability_map, stats)
+        # only a finished pass replaces the previous map, a cancelled job leaves it as it was
+        self._suitability_map, self._map_backend, self._suitability_stats = suitability_map, backend, stats
+        self.cache = None
+        self._map_stale = False
+
+    def _fused_pass(self, inputs):
+        # one fused pass: each criterion source is read once and only the map is written
+        weights = [weight for _, _, _, weight in inputs]
+        expression = WeightedSumNode([expression for _, _, expression, _ in inputs], weights)
+        suitability_map, backend = self.new_map()
+        stats = StatsAccumulator(self.output_range(weights))
+        outputs = self._stats_outputs(range(len(inputs)))
+        evaluate([Output(expression, suitability_map, backend, stats)] + outputs, self.tile_config)
+        self._store_stats_outputs(outputs)
+        self._replace_map(suitability_map, backend, stats)
+
+    def _sum_pass(self, inputs, shape, changed, previous):
+        # the map from the kept weighted sum, only the changed criteria are read: a delta pass reads
+        # the old and new transform of each, without a previous state every criterion is added
+        weights = [weight for _, _, _, weight in inputs]
+        outputs = self._stats_outputs(changed)
+        state = ContributionState(shape, inputs)
+        suitability_map, backend = self.new_map()
+        stats = StatsAccumulator(self.output_range(weights))
+        expressions = [inputs[i][2] for i in changed]
+        if previous is not None:
+            expressions += [previous.inputs[i][2] for i in changed]
+
+        def task(tile, memo):
+            row, col, nrows, ncols = tile
+            window = (slice(row, row + nrows), slice(col, col + ncols))
+            with np.errstate(all='ignore'):
+                if previous is None:
+                    total = np.zeros((nrows, ncols))
+                    missing = np.zeros((nrows, ncols), dtype=np.int32)
+                else:
+                    total = np.array(previous.total[window])
+                    missing = previous.missing[window].astype(np.int32)
+                for i in changed:
+                    if previous is not None:
+                        _, _, expression, weight = previous.inputs[i]
+                        add_contribution(total, missing, expression.compute(memo, tile), weight, -1)
+                    _, _, expression, weight = inputs[i]
+                    add_contribution(total, missing, expression.compute(memo, tile), weight)
+                # rounded to float32 like compute_tile()
+                values = total.astype(np.float32)
+                values[missing > 0] = np.nan
+                tile_stats = StatsAccumulator(stats.value_range, stats.n_bins).update(values)
+            return total, missing, values, tile_stats, compute_tile(outputs, tile, memo)
+
+        for tile, (total, missing, values, tile_stats, results) in schedule(expressions, self.tile_config, task):
+            row, col, nrows, ncols = tile
+            state.total[row:row + nrows, col:col + ncols] = total
+            state.missing[row:row + nrows, col:col + ncols] = missing
+            backend.write(suitability_map, values, row, col)
+            Profiling.count(bytes_written=values.nbytes)
+            stats.merge(tile_stats)
+            store_tile(outputs, tile, results)
+        self._store_stats_outputs(outputs)
+        self._replace_map(suitability_map, backend, stats)
+        self._state = state
+
+    def calculate_async(self, on_progress=None):
+        # calculate() in a background Job that starts as soon as the pending transform_async()
+        # jobs of the criteria are done
+        after = [criterion.job for criterion in self.criteria if criterion.job is not None and not criterion.job.done()]
+        thread_safe = all(getattr(criterion.backend, 'thread_safe', False) for criterion in self.criteria)
+
+        def run():
+            self.calculate()
+            return self
+
+        self.job = Jobs.Job('calculate', on_progress).start(run, after, None if thread_safe else Jobs.SERIAL_LOCK)
+        return self.job
+
+    def create_map(self):
+        self._suitability_map, self._map_backend = self.new_map()
+
+    def new_map(self):
+        # (raster, backend) of an empty map on the grid the criteria are evaluated on
+        if self.backend is None:
+            self.backend = self.criteria[0].backend
+        like, backend = self.criteria[0].input_raster()
+        # preview levels are NumPy rasters whatever backend the criteria read
+        backend = self.backend if like is self.criteria[0].raster else backend
+        return backend.create_like(like), backend
+
+    def cache_criteria(self):
+        # one pass that keeps every scaled criterion in memory, afterwards set_weight() is incremental
+        if self.backend is None:
+            self.backend = self.criteria[0].backend
+        with self.profiler.stage('cache_criteria'):
+            self.cache = InteractiveCache(self.criteria, self.effective_weights(), self.tile_config)
+        if self._suitability_map is None:
+            self.create_map()
+        self._suitability_stats = None
+        self._map_stale = True
+
+    def set_weight(self, index, weight):
+        # output += delta_w * criterion, the map and histogram are refreshed lazily on next access
+        if self.cache is None or self.cache.stale(self.criteria):
+            self.cache_criteria()
+        self.weight[index] = weight
+        with self.profiler.stage('set_weight'):
+            self.cache.set_weight(index, self.effective_weights()[index])
+            Profiling.count(cells=self.cache.output.size)
+        self._suitability_stats = None
+        self._map_stale = True
+
+    def export_map(self, path, quantize=None, level=COMPRESSION_LEVEL):
+        # compressed copy of the suitability map for archiving, quantized over the output range
+        # when quantize is 'uint8' or 'uint16'
+        raster = self.suitability_map
+        with self.profiler.stage('export'):
+            return CompactRaster.from_raster(self._map_backend, raster, path, quantize,
+                                             self.output_range(self.effective_weights()), self.tile_config, level)
+
+    def profile_summary(self):
+        # per stage wall time, cells, bytes read and written and cache hits, empty without a profiler
+        return self.profiler.summary()
+
+    def preview(self, level=2):
+        # transforms, weighted sum, statistics and histograms on pyramid level `level` of every
+        # criterion, one cell in 4**level, until full_resolution() is called
+        for criterion in self.criteria:
+            criterion.preview(level)
+        self.reset_map()
+
+    def full_resolution(self):
+        for criterion in self.criteria:
+            criterion.full_resolution()
+        self.reset_map()
+
+    def reset_map(self):
+        self.cache = None
+        self._suitability_map = None
+        self._suitability_stats = None
+        self._map_stale = False
+
+    def preview_error(self):
+        # estimated distance of the preview histogram and moments from a full resolution run
+        level = self.criteria[0].preview_level
+        if level is None or self.suitability_stats is None:
+            return None
+        height, width = self.criteria[0].backend.shape(self.criteria[0].raster)
+        fraction = float(np.prod(level_shape(height, width, level))) / (height * width)
+        return sampling_error(self.suitability_stats, fraction)
+
+    def weighted_moments(self):
+        # mean and standard deviation of the current weights in constant time, needs cache_criteria()
+        return self.cache.moments()
+
+    def output_range(self, weights):
+        # bounds of the weighted sum from the criteria ranges, fixes the histogram range before the pass
+        lo, hi = 0.0, 0.0
+        for criterion, weight in zip(self.criteria, weights):
+            ends = [weight * v for v in criterion.value_range()]
+            lo += min(ends)
+            hi += max(ends)
+        return lo, hi
 
-        x = []
-        for r, c in self.suitability_map:
-            x.append(self.suitability_map[r, c])
-        self.suitability_values = list(filter(lambda v: not math.isnan(v), x))
+    def compare_parallel(self, workers):
+        # times calculate() serially and with `workers` threads on the same tiles
+        config = self.tile_config
+        for criterion in self.criteria:
+            # warm up so both runs do the same work
+            criterion.transformed_stats
+        runs = []
+        try:
+            for n in (1, workers):
+                self.tile_config = TileConfig(config.tile_shape, config.memory_budget, n)
+                start = time.perf_counter()
+                # a full pass each time, otherwise the second run finds nothing changed
+                self.calculate(full=True)
+                runs.append((time.perf_counter() - start, self.suitability_map, self.suitability_stats))
+        finally:
+            self.tile_config = config
+        (serial, serial_map, serial_stats), (parallel, parallel_map, parallel_stats) = runs
+        identical = serial_stats.as_dict() == parallel_stats.as_dict() and \
+            np.array_equal(serial_stats.counts, parallel_stats.counts)
+        backend = self._map_backend
+        for row, col, nrows, ncols in config.tiles(*backend.shape(serial_map)):
+            identical = identical and np.array_equal(backend.read(serial_map, row, col, nrows, ncols),
+                                                     backend.read(parallel_map, row, col, nrows, ncols),
+                                                     equal_nan=True)
+        return {'workers': workers, 'serial_seconds': serial, 'parallel_seconds': parallel,
+                'speedup': serial / parallel, 'identical': identical}
 
     def show_stats(self):
-        print('Mean: {}'.format(self.suitability_map.mean))
-        print('Min: {}'.format(self.suitability_map.minimum))
-        print('Max: {}'.format(self.suitability_map.maximum))
+        stats = self.suitability_stats.as_dict()
+        print('Mean: {}'.format(stats['mean']))
+        print('Min: {}'.format(stats['min']))
+        print('Max: {}'.format(stats['max']))
 
     def show_hist(self, n_bins=20):
+        counts, edges = self.suitability_stats.histogram(n_bins)
         fig, ax1 = plt.subplots()
-        ax1.hist(self.suitability_values, bins=n_bins)
+        ax1.hist(edges[:-1], bins=edges, weights=counts)
         ax1.set_xlabel('Suitability Map')
         ax1.set_ylabel('Count')
         plt.title('Histogram of Suitability Map')
@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+import numpy as np
+from Tiling import DEFAULT_TILE_SHAPE, TileConfig, accumulate_raster
+
+# On disk layout: <path>.raw holds the tiles one after the other in row major tile order, each tile
+# padded to the full tile shape, so a tile is one contiguous block of the memory map.
+# <path>.json is the sidecar with the shape, tile shape, dtype, NoData value, georeference and stats.
+
+
+class TiledRaster:
+    def __init__(self, path, mode='r'):
+        self.path = os.path.abspath(path)
+        with open(self.path + '.json') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.tile_shape = tuple(meta['tile_shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        # None for float rasters, NaN is NoData there
+        self.nodata = meta['nodata']
+        self.transform = tuple(meta['transform'])
+        self.name = meta['name']
+        self.spatial_reference = meta['spatial_reference']
+        self.stats = meta.get('stats')
+        self.mode = mode
+        grid = (-(-self.shape[0] // self.tile_shape[0]), -(-self.shape[1] // self.tile_shape[1]))
+        self.tiles = np.memmap(self.path + '.raw', dtype=self.dtype, mode=mode, shape=grid + self.tile_shape)
+
+    @classmethod
+    def create(cls, path, shape, tile_shape=DEFAULT_TILE_SHAPE, dtype=np.float32, nodata=None,
+               transform=(0, 1, 0, 0, 0, -1), name='raster', spatial_reference=None):
+        dtype = np.dtype(dtype)
+        if nodata is None and not np.issubdtype(dtype, np.floating):
+            nodata = int(np.iinfo(dtype).min)
+        meta = {'shape': list(shape), 'tile_shape': list(tile_shape), 'dtype': dtype.str, 'nodata': nodata,
+                'transform': list(transform), 'name': name, 'spatial_reference': spatial_reference}
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+        grid = (-(-shape[0] // tile_shape[0]), -(-shape[1] // tile_shape[1]))
+        tiles = np.memmap(path + '.raw', dtype=dtype, mode='w+', shape=grid + tuple(tile_shape))
+        tiles[...] = np.nan if nodata is None else nodata
+        tiles.flush()
+        del tiles
+        return cls(path, mode='r+')
+
+    @classmethod
+    def from_raster(cls, backend, raster, path, tile_shape=DEFAULT_TILE_SHAPE, dtype=np.float32):
+        # streams any backend raster into the tiled format, one tile at a time
+        height, width = backend.shape(raster)
+        tiled = cls.create(path, (height, width), tile_shape, dtype, name=backend.name(raster),
+                           transform=getattr(raster, 'transform', (0, 1, 0, 0, 0, -1)),
+                           spatial_reference=getattr(raster, 'spatial_reference', None))
+        tiled_backend = TiledBackend()
+        for row, col, nrows, ncols in TileConfig(tile_shape).tiles(height, width):
+            tiled_backend.write(tiled, backend.read(raster, row, col, nrows, ncols), row, col)
+        tiled.flush()
+        return tiled
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    def flush(self):
+        if self.mode != 'r':
+            self.tiles.flush()
+            meta = {'shape': list(self.shape), 'tile_shape': list(self.tile_shape), 'dtype': self.dtype.str,
+                    'nodata': self.nodata, 'transform': list(self.transform), 'name': self.name,
+                    'spatial_reference': self.spatial_reference, 'stats': self.stats}
+            with open(self.path + '.json', 'w') as f:
+                json.dump(meta, f)
+
+    def pieces(self, row, col, nrows, ncols):
+        # (tile index, slice inside the tile, slice inside the requested window) per overlapped tile
+        th, tw = self.tile_shape
+        for ti in range(row // th, (row + nrows - 1) // th + 1):
+            r0, r1 = max(row, ti * th), min(row + nrows, (ti + 1) * th)
+            for tj in range(col // tw, (col + ncols - 1) // tw + 1):
+                c0, c1 = max(col, tj * tw), min(col + ncols, (tj + 1) * tw)
+                yield (ti, tj), (slice(r0 - ti * th, r1 - ti * th), slice(c0 - tj * tw, c1 - tj * tw)), \
+                    (slice(r0 - row, r1 - row), slice(c0 - col, c1 - col))
+
+
+class FileBackend:
+    # shared by the backends of rasters kept in files next to a JSON sidecar
+    def __init__(self, directory=None):
+        # where create_like() puts new rasters, by default a temporary folder per raster that is
+        # removed with the raster
+        self.directory = directory
+
+    def shape(self, raster):
+        return raster.shape
+
+    def name(self, raster):
+        return raster.name
+
+    def new_path(self, name):
+        directory = self.directory if self.directory is not None else tempfile.mkdtemp(prefix='suitability_')
+        return os.path.join(directory, '{}_{}'.format(name, uuid.uuid4().hex[:8]))
+
+    def track(self, raster):
+        # a raster in a temporary folder of its own deletes the folder once it is garbage collected,
+        # e.g. a suitability map replaced by the next calculate(), or at exit
+        if self.directory is None:
+            weakref.finalize(raster, shutil.rmtree, os.path.dirname(raster.path), True)
+        return raster
+
+
+class TiledBackend(FileBackend):
+    # memory maps of disjoint tiles can be read from worker threads
+    thread_safe = True
+
+    def identity(self, raster):
+        return {'path': raster.path, 'mtime': os.path.getmtime(raster.path + '.raw')}
+
+    def read(self, raster, row, col, nrows, ncols):
+        th, tw = raster.tile_shape
+        if row % th == 0 and col % tw == 0 and nrows <= th and ncols <= tw:
+            # the window is one stored tile, a zero copy view of the memory map
+            values = raster.tiles[row // th, col // tw, :nrows, :ncols]
+        else:
+            values = np.empty((nrows, ncols), dtype=raster.dtype)
+            for index, inner, outer in raster.pieces(row, col, nrows, ncols):
+                values[outer] = raster.tiles[index][inner]
+        if raster.nodata is None:
+            # float tiles with NaN NoData are handed out as they are stored
+            return values
+        out = values.astype(np.float64)
+        out[values == raster.nodata] = np.nan
+        return out
+
+    def write(self, raster, values, row, col):
+        nrows, ncols = values.shape
+        if raster.nodata is not None:
+            values = np.where(np.isnan(values), raster.nodata, values)
+        for index, inner, outer in raster.pieces(row, col, nrows, ncols):
+            raster.tiles[index][inner] = values[outer]
+        raster.stats = None
+
+    def create_like(self, raster):
+        return self.track(TiledRaster.create(self.new_path(raster.name), (raster.height, raster.width),
+                                             getattr(raster, 'tile_shape', DEFAULT_TILE_SHAPE),
+                                             transform=getattr(raster, 'transform', (0, 1, 0, 0, 0, -1)),
+                                             name=raster.name,
+                                             spatial_reference=getattr(raster, 'spatial_reference', None)))
+
+    def calculate_statistics(self, raster):
+        self.set_statistics(raster, accumulate_raster(self, raster, TileConfig(raster.tile_shape)))
+
+    def set_statistics(self, raster, stats):
+        # kept in the sidecar so reopening the raster does not rescan it
+        raster.stats = stats.as_dict()
+        raster.flush()
+
+    def statistics(self, raster):
+        if raster.stats is None:
+            self.calculate_statistics(raster)
+        return raster.stats
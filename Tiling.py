@@ -0,0 +1,109 @@
+import math
+import numpy as np
+import Jobs
+import Profiling
+from RasterStats import StatsAccumulator
+
+# default tile shape (rows, columns) streamed through the pipeline
+DEFAULT_TILE_SHAPE = (1024, 1024)
+
+
+class TileConfig:
+    def __init__(self, tile_shape=DEFAULT_TILE_SHAPE, memory_budget=None, workers=1):
+        self.tile_shape = tuple(tile_shape)
+        # upper bound in bytes for the float64 working arrays of one tile, None for no limit. The tile
+        # shape does not depend on the worker count so parallel runs tile (and round) exactly like serial
+        # ones, the scheduler holds at most tiles_in_flight tiles at a time
+        self.memory_budget = memory_budget
+        # threads computing tiles concurrently, 1 runs everything in the calling thread
+        self.workers = workers
+
+    @property
+    def tiles_in_flight(self):
+        # the scheduler keeps two tiles queued per worker
+        return 1 if self.workers <= 1 else 2 * self.workers
+
+    def tile_shape_for(self, n_arrays=1):
+        rows, cols = self.tile_shape
+        if self.memory_budget is not None:
+            # halve the longer side until n_arrays double precision tiles fit in the budget
+            while rows * cols * 8 * n_arrays > self.memory_budget and rows * cols > 1:
+                if rows >= cols:
+                    rows = max(1, rows // 2)
+                else:
+                    cols = max(1, cols // 2)
+        return rows, cols
+
+    def tiles(self, height, width, n_arrays=1):
+        rows, cols = self.tile_shape_for(n_arrays)
+        for row in range(0, height, rows):
+            for col in range(0, width, cols):
+                yield row, col, min(rows, height - row), min(cols, width - col)
+
+
+def iter_valid_values(backend, raster, config):
+    # yields the non NoData cells tile by tile
+    tiles = list(config.tiles(*backend.shape(raster), n_arrays=2))
+    Jobs.start_pass(len(tiles))
+    for row, col, nrows, ncols in tiles:
+        values = backend.read(raster, row, col, nrows, ncols)
+        Profiling.count(cells=nrows * ncols, bytes_read=values.nbytes)
+        yield values[~np.isnan(values)]
+        Jobs.tile_done()
+
+
+def accumulate_raster(backend, raster, config, value_range=None):
+    stats = StatsAccumulator(value_range)
+    for values in iter_valid_values(backend, raster, config):
+        stats.update(values)
+    return stats
+
+
+class Sampling:
+    # how Criteria gets the statistics of its source:
+    #   'backend' exact min/max/mean/std from the backend (stored statistics for arcpy rasters),
+    #             histogram from a sample
+    #   'sample'  everything estimated from a sample, nothing scales with the raster size
+    #   'exact'   histogram from a scan of every cell
+    # the sample is about sample_size cells read in window sized blocks, one block at a random
+    # position in each cell of a regular grid over the raster, so every region is represented
+    def __init__(self, method='backend', sample_size=250000, seed=0, window=(16, 16)):
+        if method not in ('backend', 'sample', 'exact'):
+            raise ValueError('Unknown sampling method: {}'.format(method))
+        self.method = method
+        self.sample_size = sample_size
+        self.seed = seed
+        self.window = tuple(window)
+
+    def key(self):
+        return {'method': self.method, 'sample_size': self.sample_size, 'seed': self.seed,
+                'window': list(self.window)}
+
+    def covers(self, height, width):
+        # small rasters are read whole, a sample would cost the same
+        return self.method == 'exact' or height * width <= self.sample_size
+
+    def windows(self, height, width):
+        rows, cols = min(self.window[0], height), min(self.window[1], width)
+        n = max(1, self.sample_size // (rows * cols))
+        # strata grid with about n cells and the aspect of the raster
+        grid_rows = max(1, min(height // rows, int(round(math.sqrt(n * height / width)))))
+        grid_cols = max(1, min(width // cols, int(math.ceil(n / grid_rows))))
+        rng = np.random.default_rng(self.seed)
+        for i in range(grid_rows):
+            r0, r1 = i * height // grid_rows, (i + 1) * height // grid_rows
+            for j in range(grid_cols):
+                c0, c1 = j * width // grid_cols, (j + 1) * width // grid_cols
+                row = r0 + int(rng.integers(0, max(1, r1 - r0 - rows + 1)))
+                col = c0 + int(rng.integers(0, max(1, c1 - c0 - cols + 1)))
+                yield row, col, min(rows, height - row), min(cols, width - col)
+
+
+def sample_valid_values(backend, raster, sampling):
+    # non NoData cells of the sample windows, at most about sampling.sample_size of them
+    chunks = []
+    for row, col, nrows, ncols in sampling.windows(*backend.shape(raster)):
+        values = backend.read(raster, row, col, nrows, ncols)
+        Profiling.count(cells=nrows * ncols, bytes_read=values.nbytes)
+        chunks.append(values[~np.isnan(values)])
+    return np.concatenate(chunks) if chunks else np.zeros(0)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import Profiling
+
+# bump when the layout of an entry changes so old entries are never read
+CACHE_FORMAT = 2
+
+
+def canonical(value):
+    # JSON friendly form of a params dict, remap dicts keep their order since later
+    # overlapping intervals win
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value):
+            return {k: canonical(v) for k, v in value.items()}
+        return [[canonical(k), canonical(v)] for k, v in value.items()]
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def cache_key(*parts):
+    text = json.dumps([CACHE_FORMAT] + [canonical(p) for p in parts], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TransformCache:
+    # content addressed entries on disk, each a folder of .npy arrays and tiled rasters plus
+    # meta.json, read back memory mapped. The least recently used entries are evicted past max_bytes.
+    def __init__(self, directory, max_bytes=4 * 1024 ** 3):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # (meta, arrays) or None, arrays are read only memory maps
+        if not os.path.exists(os.path.join(self.entry_path(key), 'meta.json')):
+            self.misses += 1
+            Profiling.count(cache_misses=1)
+            return None
+        self.hits += 1
+        Profiling.count(cache_hits=1)
+        return self.load(key)
+
+    def load(self, key):
+        path = self.entry_path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+        # the modification time of meta.json is the LRU clock
+        os.utime(meta_path)
+        return meta['meta'], arrays
+
+    def pending_path(self, key):
+        return os.path.join(self.directory, '.pending-' + key)
+
+    def put(self, key, meta, arrays):
+        # files the caller already wrote into pending_path(key) are committed with the entry
+        path = self.pending_path(key)
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), np.asarray(array))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'meta': canonical(meta), 'arrays': list(arrays)}, f)
+        final = self.entry_path(key)
+        if os.path.exists(final):
+            shutil.rmtree(final, ignore_errors=True)
+        os.replace(path, final)
+        self.evict(keep=key)
+        return self.load(key)
+
+    def discard(self, key):
+        shutil.rmtree(self.pending_path(key), ignore_errors=True)
+
+    def entries(self):
+        # (last access, bytes, key) of every committed entry
+        result = []
+        for key in os.listdir(self.directory):
+            meta_path = os.path.join(self.directory, key, 'meta.json')
+            if key.startswith('.') or not os.path.exists(meta_path):
+                continue
+            folder = os.path.join(self.directory, key)
+            size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+            result.append((os.path.getmtime(meta_path), size, key))
+        return result
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                shutil.rmtree(self.entry_path(key))
+            except OSError:
+                # still memory mapped by a criterion on Windows, try again next time
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
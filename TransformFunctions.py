@@ -0,0 +1,257 @@
+import json
+import math
+from collections import OrderedDict, namedtuple
+import numpy as np
+from TransformCache import canonical
+
+# The RBF functions of Criteria.transform('continous', ...). One function object fills in the
+# default params from the source statistics and evaluates the curve on arrays, so the same code
+# draws the 100 point plot curve and transforms the raster.
+
+SourceStats = namedtuple('SourceStats', ['min', 'max', 'mean', 'std'])
+
+# plot curves kept by sample_curve()
+CURVE_CACHE_SIZE = 256
+
+
+class TransformFunction:
+    name = None
+    # bump when the formula changes so cached transforms of the old one are not reused
+    version = 1
+
+    def defaults(self, params, stats):
+        # fills the params left out, in place, from the SourceStats of the criterion
+        pass
+
+    def bind(self, params, stats):
+        # vectorized function of a float64 array with the params applied
+        raise NotImplementedError
+
+
+TRANSFORM_FUNCTIONS = {}
+_curves = OrderedDict()
+
+
+def register(function):
+    # works as a class decorator too, a registered name replaces the previous function
+    instance = function() if isinstance(function, type) else function
+    TRANSFORM_FUNCTIONS[instance.name] = instance
+    return function
+
+
+def get_function(name):
+    if name not in TRANSFORM_FUNCTIONS:
+        raise ValueError('Unknown continous transform: {}'.format(name))
+    return TRANSFORM_FUNCTIONS[name]
+
+
+def sample_curve(function, params, stats, samples):
+    # the function on the plot samples, memoized per (function, params, stats)
+    key = (id(function), function.version, json.dumps(canonical(params), sort_keys=True), tuple(stats),
+           len(samples), samples[0] if samples else None)
+    if key in _curves:
+        _curves.move_to_end(key)
+    else:
+        with np.errstate(all='ignore'):
+            _curves[key] = function.bind(params, stats)(np.asarray(samples, dtype=np.float64))
+        if len(_curves) > CURVE_CACHE_SIZE:
+            _curves.popitem(last=False)
+    return _curves[key].tolist()
+
+
+@register
+class Small(TransformFunction):
+    name = 'small'
+    default_spread = 5
+
+    def defaults(self, params, stats):
+        if 'mid_point' not in params:
+            params['mid_point'] = (stats.max + stats.min) / 2
+        if 'spread' not in params:
+            params['spread'] = self.default_spread
+
+    def bind(self, params, stats):
+        mid_point, spread = params['mid_point'], params['spread']
+        return lambda v: 1 / (1 + np.power(v / mid_point, spread))
+
+
+@register
+class Large(Small):
+    name = 'large'
+    default_spread = -5
+
+
+@register
+class MSSmall(TransformFunction):
+    name = 'mssmall'
+    # NoData cells used to get the value for cells below the mean
+    version = 2
+
+    def defaults(self, params, stats):
+        if 'mean_multiplier' not in params:
+            params['mean_multiplier'] = 1
+        if 'std_multiplier' not in params:
+            params['std_multiplier'] = 1
+
+    def bind(self, params, stats):
+        n_mean = params['mean_multiplier'] * stats.mean
+        n_std = params['std_multiplier'] * stats.std
+        # written so NaN fails the test and stays NoData
+        return lambda v: np.where(v <= n_mean, 1, n_std / (v - n_mean + n_std))
+
+
+@register
+class MSLarge(MSSmall):
+    name = 'mslarge'
+    # the raster used v - s / (x - m + s) while the plot used 1 - s / (x - m + s)
+    version = 3
+
+    def bind(self, params, stats):
+        n_mean = params['mean_multiplier'] * stats.mean
+        n_std = params['std_multiplier'] * stats.std
+        return lambda v: np.where(v <= n_mean, 0, 1 - n_std / (v - n_mean + n_std))
+
+
+@register
+class Gaussian(TransformFunction):
+    name = 'gaussian'
+
+    def defaults(self, params, stats):
+        if 'mid_point' not in params:
+            params['mid_point'] = (stats.max + stats.min) / 2
+        if 'spread' not in params:
+            params['spread'] = math.log(10) * 4 / math.pow(params['mid_point'] - stats.min, 2)
+
+    def bind(self, params, stats):
+        mid_point, spread = params['mid_point'], params['spread']
+        return lambda v: np.exp(-spread * (v - mid_point) ** 2)
+
+
+@register
+class Near(TransformFunction):
+    name = 'near'
+
+    def defaults(self, params, stats):
+        if 'mid_point' not in params:
+            params['mid_point'] = (stats.max + stats.min) / 2
+        if 'spread' not in params:
+            params['spread'] = 36 / math.pow(params['mid_point'] - stats.min, 2)
+
+    def bind(self, params, stats):
+        mid_point, spread = params['mid_point'], params['spread']
+        return lambda v: 1 / (1 + spread * np.power(v - mid_point, 2))
+
+
+@register
+class Linear(TransformFunction):
+    name = 'linear'
+
+    def defaults(self, params, stats):
+        if 'min_x' not in params:
+            params['min_x'] = stats.min
+        if 'max_x' not in params:
+            params['max_x'] = stats.max
+
+    def bind(self, params, stats):
+        # positive slope, assume always the case
+        min_x, max_x = params['min_x'], params['max_x']
+        diff = max_x - min_x
+        return lambda v: np.where(v < min_x, 0, np.where(v > max_x, 1, (v - min_x) / diff))
+
+
+@register
+class SymmetricLinear(Linear):
+    name = 'symmetriclinear'
+
+    def bind(self, params, stats):
+        min_x, max_x = params['min_x'], params['max_x']
+        h_diff = 0.5 * (max_x - min_x)
+        mid_p = min_x + h_diff
+        return lambda v: np.where(v < min_x, 0, np.where(v < mid_p, (v - min_x) / h_diff,
+                                                         np.where(v > max_x, 0, (max_x - v) / h_diff)))
+
+
+@register
+class Exponential(TransformFunction):
+    name = 'exponential'
+
+    def defaults(self, params, stats):
+        if 'in_shift' in params and 'base_factor' in params:
+            return
+        log_from, log_to = math.log(params['from_scale']), math.log(params['to_scale'])
+        if 'in_shift' not in params:
+            params['in_shift'] = (stats.min * log_to - stats.max * log_from) / (log_to - log_from)
+        if 'base_factor' not in params:
+            params['base_factor'] = (log_to - log_from) / (stats.max - stats.min)
+
+    def bind(self, params, stats):
+        in_shift, base_factor = params['in_shift'], params['base_factor']
+        return lambda v: np.exp((v - in_shift) * base_factor)
+
+
+@register
+class Logarithm(TransformFunction):
+    name = 'logarithm'
+
+    def defaults(self, params, stats):
+        if 'in_shift' in params and 'base_factor' in params:
+            return
+        exp_from, exp_to = math.exp(params['from_scale']), math.exp(params['to_scale'])
+        if 'in_shift' not in params:
+            params['in_shift'] = (stats.min * exp_to - stats.max * exp_from) / (exp_to - exp_from)
+        if 'base_factor' not in params:
+            params['base_factor'] = (exp_to - exp_from) / (stats.max - stats.min)
+
+    def bind(self, params, stats):
+        in_shift, base_factor = params['in_shift'], params['base_factor']
+        return lambda v: np.log((v - in_shift) * base_factor)
+
+
+@register
+class Power(TransformFunction):
+    name = 'power'
+
+    def defaults(self, params, stats):
+        if params['from_scale'] == 0:
+            in_shift = stats.min
+            if params['to_scale'] <= 1:
+                exponent = 1
+            else:
+                exponent = math.log(params['to_scale']) / (stats.max - in_shift)
+        elif params['from_scale'] == 1:
+            in_shift = stats.min - 1
+            exponent = math.log(params['to_scale']) / math.log(stats.max - in_shift)
+        else:
+            in_shift = stats.min
+            exponent = 2
+        if 'in_shift' not in params:
+            params['in_shift'] = in_shift
+        if 'exponent' not in params:
+            params['exponent'] = exponent
+
+    def bind(self, params, stats):
+        in_shift, exponent = params['in_shift'], params['exponent']
+        return lambda v: np.power(v - in_shift, exponent)
+
+
+@register
+class LogisticGrowth(TransformFunction):
+    name = 'logisticgrowth'
+    default_y_intercept_percent = 1
+
+    def defaults(self, params, stats):
+        if 'y_intercept_percent' not in params:
+            params['y_intercept_percent'] = self.default_y_intercept_percent
+
+    def bind(self, params, stats):
+        c = 100
+        a = c / params['y_intercept_percent'] - 1
+        b = - math.log(a) / (0.5 * (stats.max + stats.min) - stats.min)
+        minimum = stats.min
+        return lambda v: c / (1 + a * np.exp((v - minimum) * b))
+
+
+@register
+class LogisticDecay(LogisticGrowth):
+    name = 'logisticdecay'
+    default_y_intercept_percent = 99
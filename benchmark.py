@@ -0,0 +1,205 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import platform
+import time
+from Profiling import Profiler
+from SuitabilityModel import *
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then left out of the results
+    resource = None
+
+RBF_NAMES = ['small', 'large', 'mssmall', 'mslarge', 'gaussian', 'near', 'linear', 'symmetriclinear',
+             'exponential', 'logarithm', 'power', 'logisticgrowth', 'logisticdecay']
+LANDUSE_CLASSES = [5, 7, 11, 12, 13, 14, 17, 24, 41, 42, 43, 61, 62, 211, 212]
+MODEL_SIZES = [1, 2, 5, 10, 20]
+
+
+def peak_rss_mb():
+    # peak of the whole process so far, it never goes down so every case runs in a process of its own
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if platform.system() == 'Darwin' else peak / 1024
+
+
+def synthetic_raster(rows, cols, nodata, dtype, seed, categorical=False):
+    rng = np.random.default_rng(seed)
+    if categorical:
+        data = rng.choice(LANDUSE_CLASSES, (rows, cols))
+    else:
+        y, x = np.mgrid[0:rows, 0:cols]
+        data = 587 + (4066 - 587) * (0.5 + 0.25 * np.sin(x / 97.0) + 0.25 * np.cos(y / 131.0))
+        data += rng.normal(0, 25, (rows, cols))
+    mask = rng.random((rows, cols)) < nodata
+    return NumpyRaster(data.astype(dtype), mask, name='synthetic_{}'.format(seed))
+
+
+def transform_cases():
+    # (label, type, params) for every transform the notebook offers
+    cases = [('continous/' + name, 'continous', {'name': name, 'from_scale': 1, 'to_scale': 10})
+             for name in RBF_NAMES]
+    cases.append(('unique', 'unique', {'from_scale': 1, 'to_scale': 10,
+                                       'remap': {v: 10 if v in (41, 42, 43) else 1 for v in LANDUSE_CLASSES}}))
+    edges = np.linspace(587, 4066, 11)
+    cases.append(('range', 'range', {'from_scale': 1, 'to_scale': 10,
+                                     'remap': {(float(edges[i]), float(edges[i + 1])): i + 1 for i in range(10)}}))
+    return cases
+
+
+class Stages:
+    # wall time of each named stage of one benchmark case
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    def split(self, stage, profiler, inner):
+        # moves the time of profiler stage `inner` out of `stage` into a stage of its own
+        seconds = profiler.summary().get(inner, {}).get('seconds', 0.0)
+        self.seconds[stage] -= seconds
+        self.seconds[inner] = self.seconds.get(inner, 0.0) + seconds
+        profiler.reset()
+
+
+def case_result(name, stages, cells):
+    total = sum(stages.seconds.values())
+    return {'case': name, 'cells': cells, 'seconds': total, 'cells_per_second': cells / total if total else None,
+            'stages': stages.seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+def isolated(func, *args):
+    # func(*args) in a new interpreter, so the peak RSS of the result is that of this one case
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def transform_case(args, config, label, type, params):
+    raster = synthetic_raster(args.rows, args.cols, args.nodata, args.dtype, 1, type == 'unique')
+    stages = Stages()
+    profiler = Profiler()
+    criterion = stages.run('source_stats', Criteria, raster, config, profiler=profiler)
+    profiler.reset()
+    # the min/max pass of the final rescale of continous transforms is timed on its own
+    stages.run('transform', criterion.transform, type, params)
+    stages.split('transform', profiler, 'rescale')
+    stages.run('evaluate', lambda: criterion.transformed_stats)
+    return case_result(label, stages, args.rows * args.cols)
+
+
+def model_case(args, config, n):
+    cases = [case for case in transform_cases() if case[1] == 'continous']
+    # the inputs are built outside the timed stages
+    rasters = [synthetic_raster(args.rows, args.cols, args.nodata, args.dtype, 100 + i) for i in range(n)]
+    stages = Stages()
+    profiler = Profiler()
+    criteria = []
+    for i, raster in enumerate(rasters):
+        criterion = stages.run('source_stats', Criteria, raster, config, profiler=profiler)
+        profiler.reset()
+        label, type, params = cases[i % len(cases)]
+        stages.run('transform', criterion.transform, type, copy.deepcopy(params))
+        stages.split('transform', profiler, 'rescale')
+        criteria.append(criterion)
+    model = SuitabilityModel(tile_config=config)
+    for criterion in criteria:
+        model.add_criteria(criterion, 1)
+    # rescales are resolved above, this is the fused weighted sum and its statistics
+    stages.run('calculate', model.calculate)
+    return case_result('model/{}'.format(n), stages, args.rows * args.cols * n)
+
+
+def bench_transforms(args, config):
+    results = []
+    for label, type, params in transform_cases():
+        if args.only and not any(pattern in label for pattern in args.only):
+            continue
+        for repeat in range(args.repeat):
+            results.append(isolated(transform_case, args, config, label, type, params))
+    return results
+
+
+def bench_models(args, config):
+    results = []
+    for n in args.models:
+        if args.only and not any(pattern in 'model/{}'.format(n) for pattern in args.only):
+            continue
+        for repeat in range(args.repeat):
+            results.append(isolated(model_case, args, config, n))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # cases at least `tolerance` slower, or with a peak RSS at least `tolerance` higher, than the
+    # best run of the same case in the baseline
+    best = {}
+    for result in baseline['results']:
+        for metric in ('seconds', 'peak_rss_mb'):
+            if result.get(metric) is not None:
+                key = (result['case'], metric)
+                best[key] = min(best.get(key, np.inf), result[metric])
+    regressions = []
+    for result in results:
+        for metric in ('seconds', 'peak_rss_mb'):
+            key = (result['case'], metric)
+            if key in best and result[metric] is not None and result[metric] > best[key] * (1 + tolerance):
+                regressions.append((result['case'], metric, best[key], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every transform and the weighted sum on synthetic rasters')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--cols', type=int, default=2000)
+    parser.add_argument('--nodata', type=float, default=0.02, help='fraction of NoData cells')
+    parser.add_argument('--dtype', default='float32', help='dtype of the synthetic sources')
+    parser.add_argument('--tile', type=int, nargs=2, default=DEFAULT_TILE_SHAPE)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--models', type=int, nargs='*', default=MODEL_SIZES, help='criterion counts to benchmark')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='run only cases whose name contains one of these')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as a regression')
+    args = parser.parse_args()
+
+    config = TileConfig(args.tile, workers=args.workers)
+    results = bench_transforms(args, config) + bench_models(args, config)
+    for result in results:
+        stages = ', '.join('{} {:.3f}'.format(stage, seconds) for stage, seconds in result['stages'].items())
+        print('{:<30}{:10.3f} s{:14.3g} cells/s{:>10} MB   {}'.format(
+            result['case'], result['seconds'], result['cells_per_second'],
+            '-' if result['peak_rss_mb'] is None else '{:.0f}'.format(result['peak_rss_mb']), stages))
+
+    run = {'config': {'rows': args.rows, 'cols': args.cols, 'nodata': args.nodata, 'dtype': args.dtype,
+                      'tile': list(args.tile), 'workers': args.workers, 'repeat': args.repeat},
+           'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                           'machine': platform.machine(), 'system': platform.system()},
+           'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != run['config']:
+            print('warning: baseline was run with {}'.format(baseline['config']))
+        regressions = compare(results, baseline, args.tolerance)
+        for case, metric, before, after in regressions:
+            unit = 's' if metric == 'seconds' else 'MB'
+            print('regression {:<30}{:10.3f} {unit} -> {:.3f} {unit}'.format(case, before, after, unit=unit))
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+import asyncio
+import copy
+import gc
+import glob
+import math
+import os
+import numpy as np
+import pytest
+import tempfile
+from Profiling import Profiler
+from Scenarios import *
+
+# Regression checks of the tiled pipeline on small rasters, run with python -m pytest
+
+RBF_NAMES = ['small', 'large', 'mssmall', 'mslarge', 'gaussian', 'near', 'linear', 'symmetriclinear',
+             'exponential', 'logarithm', 'power', 'logisticgrowth', 'logisticdecay']
+UNIQUE = {'from_scale': 1, 'to_scale': 10, 'remap': {5: 1, 7: 1, 11: 1, 41: 10, 42: 10, 43: 10, 61: 1}}
+RANGE = {'from_scale': 1, 'to_scale': 10,
+         'remap': {(587, 935.8): 1, (900, 1283.6): 2, (1283.6, 2000): 3, (1900, 4066): 10}}
+# odd tile shapes so every raster edge ends in a partial tile
+TILES = TileConfig((16, 7))
+
+
+def dem(seed=0, shape=(67, 45)):
+    rng = np.random.default_rng(seed)
+    data = rng.uniform(587, 4066, shape).astype(np.float32)
+    data[rng.random(shape) < 0.1] = np.nan
+    return NumpyRaster(data, name='dem_{}'.format(seed))
+
+
+def landuse():
+    rng = np.random.default_rng(1)
+    data = rng.choice([5, 7, 11, 41, 42, 43, 61, 99], (67, 45)).astype(np.float32)
+    data[0, :5] = np.nan
+    return NumpyRaster(data, name='landuse')
+
+
+def continous(name):
+    return {'name': name, 'from_scale': 1, 'to_scale': 10}
+
+
+def reference_function(name, c, params):
+    # the per cell math module formulas of the original notebook, defaults from the same statistics
+    lo, hi, mean, std = c.min_value, c.max_value, c.mean_value, c.std_value
+    if name in ('small', 'large'):
+        mid, spread = (hi + lo) / 2, 5 if name == 'small' else -5
+        return lambda v: 1 / (1 + math.pow(v / mid, spread))
+    if name == 'mssmall':
+        return lambda v: std / (v - mean + std) if v > mean else 1
+    if name == 'mslarge':
+        return lambda v: 1 - std / (v - mean + std) if v > mean else 0
+    if name == 'gaussian':
+        mid = (hi + lo) / 2
+        spread = math.log(10) * 4 / math.pow(mid - lo, 2)
+        return lambda v: math.exp(-spread * (v - mid) ** 2)
+    if name == 'near':
+        mid = (hi + lo) / 2
+        spread = 36 / math.pow(mid - lo, 2)
+        return lambda v: 1 / (1 + spread * math.pow(v - mid, 2))
+    if name == 'linear':
+        return lambda v: 0 if v < lo else 1 if v > hi else (v - lo) / (hi - lo)
+    if name == 'symmetriclinear':
+        h_diff = 0.5 * (hi - lo)
+        return lambda v: 0 if v < lo else (v - lo) / h_diff if v < lo + h_diff else 0 if v > hi else (hi - v) / h_diff
+    if name == 'exponential':
+        log_from, log_to = math.log(params['from_scale']), math.log(params['to_scale'])
+        shift = (lo * log_to - hi * log_from) / (log_to - log_from)
+        factor = (log_to - log_from) / (hi - lo)
+        return lambda v: math.exp((v - shift) * factor)
+    if name == 'logarithm':
+        exp_from, exp_to = math.exp(params['from_scale']), math.exp(params['to_scale'])
+        shift = (lo * exp_to - hi * exp_from) / (exp_to - exp_from)
+        factor = (exp_to - exp_from) / (hi - lo)
+        return lambda v: math.log((v - shift) * factor)
+    if name == 'power':
+        shift = lo - 1
+        exponent = math.log(params['to_scale']) / math.log(hi - shift)
+        return lambda v: math.pow(v - shift, exponent)
+    a = 100 / (1 if name == 'logisticgrowth' else 99) - 1
+    b = - math.log(a) / (0.5 * (hi + lo) - lo)
+    return lambda v: 100 / (1 + a * math.exp((v - lo) * b))
+
+
+def reference_continous(c, params):
+    data = c.raster.data
+    transformed = np.full(data.shape, np.nan, dtype=np.float32)
+    func = reference_function(params['name'], c, params)
+    for (i, j), v in np.ndenumerate(data):
+        if not math.isnan(v):
+            transformed[i, j] = func(float(v))
+    lo, hi = float(np.nanmin(transformed)), float(np.nanmax(transformed))
+    scaled = np.full(data.shape, np.nan, dtype=np.float32)
+    for (i, j), t in np.ndenumerate(transformed):
+        if not math.isnan(t):
+            scaled[i, j] = (float(t) - lo) / (hi - lo) * (params['to_scale'] - params['from_scale']) + \
+                params['from_scale']
+    return scaled
+
+
+def reference_remap(c, type, params):
+    result = np.full(c.raster.data.shape, np.nan, dtype=np.float32)
+    for (i, j), v in np.ndenumerate(c.raster.data):
+        if type == 'unique' and float(v) in params['remap']:
+            result[i, j] = params['remap'][float(v)]
+        if type == 'range':
+            # later overlapping intervals win
+            for (s, e), value in params['remap'].items():
+                if s < v <= e:
+                    result[i, j] = value
+    return result
+
+
+def model(weights=(1, 2, 3), config=TILES):
+    c1 = Criteria(dem(0), tile_config=config)
+    c1.transform('continous', continous('linear'))
+    c2 = Criteria(dem(2), tile_config=config)
+    c2.transform('continous', continous('near'))
+    c3 = Criteria(landuse(), tile_config=config)
+    c3.transform('unique', copy.deepcopy(UNIQUE))
+    m = SuitabilityModel(tile_config=config)
+    for c, weight in zip((c1, c2, c3), weights):
+        m.add_criteria(c, weight)
+    return m
+
+
+def same_stats(a, b):
+    return a.as_dict() == b.as_dict() and np.array_equal(a.counts, b.counts)
+
+
+def test_memory_budget_bounds_tile_shape():
+    config = TileConfig((1024, 512), memory_budget=3 * 8 * 100 * 100)
+    rows, cols = config.tile_shape_for(n_arrays=3)
+    assert rows * cols * 8 * 3 <= config.memory_budget
+    # the longer side is halved first
+    assert (rows, cols) == (64, 128)
+    assert TileConfig((1024, 512)).tile_shape_for(n_arrays=3) == (1024, 512)
+
+
+def test_tiles_cover_every_cell_once():
+    config = TileConfig((16, 7), memory_budget=8 * 2 * 50)
+    seen = np.zeros((67, 45), dtype=int)
+    for row, col, nrows, ncols in config.tiles(67, 45, n_arrays=2):
+        assert nrows * ncols * 8 * 2 <= config.memory_budget
+        seen[row:row + nrows, col:col + ncols] += 1
+    assert (seen == 1).all()
+
+
+def test_merged_tiles_match_one_pass():
+    rng = np.random.default_rng(0)
+    values = rng.normal(5, 2, 10000)
+    values[rng.random(values.size) < 0.1] = np.nan
+    whole = StatsAccumulator((-5, 15)).update(values)
+    merged = StatsAccumulator((-5, 15))
+    for part in np.array_split(values, 7):
+        merged.merge(StatsAccumulator((-5, 15)).update(part))
+    valid = values[~np.isnan(values)]
+    assert merged.count == whole.count == valid.size
+    assert merged.mean == pytest.approx(valid.mean(), rel=1e-12)
+    assert merged.std == pytest.approx(valid.std(), rel=1e-12)
+    assert (merged.minimum, merged.maximum) == (valid.min(), valid.max())
+    assert np.array_equal(merged.counts, whole.counts)
+    with pytest.raises(ValueError):
+        merged.merge(StatsAccumulator((0, 1)).update([0.5]))
+
+
+def test_quantile_within_one_fine_bin():
+    values = np.random.default_rng(1).uniform(0, 10, 50000)
+    stats = StatsAccumulator((0, 10)).update(values)
+    bin_width = 10 / stats.counts.size
+    expected = np.quantile(values, [0.1, 0.5, 0.9])
+    assert np.abs(stats.quantile([0.1, 0.5, 0.9]) - expected).max() <= bin_width
+    assert stats.quantile(0) == pytest.approx(values.min(), abs=bin_width)
+    assert StatsAccumulator((0, 1)).quantile(0.5) is None
+
+
+def test_parallel_matches_serial():
+    serial, parallel = model(), model(config=TileConfig((16, 7), workers=3))
+    serial.calculate()
+    parallel.calculate()
+    assert np.array_equal(serial.suitability_map.data, parallel.suitability_map.data, equal_nan=True)
+    assert same_stats(serial.suitability_stats, parallel.suitability_stats)
+    m = model()
+    assert m.compare_parallel(3)['identical']
+    # the parallel run is timed on a full pass, not on an unchanged model
+    assert m.last_calculation['mode'] == 'full'
+
+
+def test_set_weight_matches_calculate():
+    m = model()
+    m.calculate()
+    m.set_weight(0, 2)
+    # a criterion transformed again after the weights were cached
+    m.criteria[1].transform('continous', continous('gaussian'))
+    m.set_weight(2, 4)
+    interactive, stats = m.suitability_map.data.copy(), m.suitability_stats.as_dict()
+    mean, std = m.weighted_moments()
+    m.calculate(full=True)
+    np.testing.assert_allclose(interactive, m.suitability_map.data, rtol=1e-6)
+    expected = m.suitability_stats.as_dict()
+    assert stats['count'] == expected['count']
+    for key in ('min', 'max', 'mean', 'std'):
+        assert stats[key] == pytest.approx(expected[key], rel=1e-6)
+    assert (mean, std) == (pytest.approx(expected['mean'], rel=1e-6), pytest.approx(expected['std'], rel=1e-5))
+
+
+def test_add_criteria_after_set_weight():
+    m = model()
+    m.calculate()
+    m.set_weight(0, 2)
+    c = Criteria(dem(4), tile_config=TILES)
+    c.transform('continous', continous('large'))
+    m.add_criteria(c, 1)
+    stats, data = m.suitability_stats, m.suitability_map.data.copy()
+    expected = model(weights=(2, 2, 3))
+    expected.add_criteria(c, 1)
+    expected.calculate()
+    assert same_stats(stats, expected.suitability_stats)
+    assert np.array_equal(data, expected.suitability_map.data, equal_nan=True)
+
+
+@pytest.mark.parametrize('type, params, raster', [('continous', continous('mssmall'), dem),
+                                                  ('continous', continous('gaussian'), dem),
+                                                  ('unique', UNIQUE, landuse)])
+def test_warm_cache_matches_cold(tmp_path, type, params, raster):
+    cache = TransformCache(str(tmp_path))
+    cold = Criteria(raster(), tile_config=TILES, cache=cache)
+    cold.transform(type, copy.deepcopy(params))
+    hits = cache.hits
+    warm = Criteria(raster(), tile_config=TILES, cache=cache)
+    warm.transform(type, copy.deepcopy(params))
+    # the source statistics and the transform
+    assert cache.hits == hits + 2
+    uncached = Criteria(raster(), tile_config=TILES)
+    uncached.transform(type, copy.deepcopy(params))
+    for c in (cold, warm):
+        assert np.array_equal(c.transformed_raster.data, uncached.transformed_raster.data, equal_nan=True)
+        assert same_stats(c.transformed_stats, uncached.transformed_stats)
+        assert c.transformed_sample_values == uncached.transformed_sample_values
+    # other source statistics, here from a sample, must not be served the cached transform
+    sampled = Criteria(raster(), tile_config=TILES, cache=cache, sampling=Sampling('sample', 500, seed=3))
+    sampled.transform(type, copy.deepcopy(params))
+    expected = Criteria(raster(), tile_config=TILES, sampling=Sampling('sample', 500, seed=3))
+    expected.transform(type, copy.deepcopy(params))
+    assert np.array_equal(sampled.transformed_raster.data, expected.transformed_raster.data, equal_nan=True)
+
+
+def test_dataset_signature_sees_edits_inside_folders(tmp_path):
+    # a GRID like folder dataset edited in place keeps the folder modification time
+    grid = tmp_path / 'dem'
+    grid.mkdir()
+    (grid / 'w001001.adf').write_bytes(b'0' * 64)
+    folder_mtime = os.path.getmtime(str(grid))
+    before = dataset_signature(str(grid))
+    (grid / 'w001001.adf').write_bytes(b'1' * 128)
+    os.utime(str(grid), (folder_mtime, folder_mtime))
+    after = dataset_signature(str(grid))
+    assert after['size'] == before['size'] + 64 and after != before
+    # a geodatabase raster is found through its .gdb folder, a raster file counts with its sidecars
+    assert dataset_signature(str(grid / 'not_a_file'))['files'] == 1
+    (tmp_path / 'dem.tif').write_bytes(b'0' * 10)
+    (tmp_path / 'dem.tif.aux.xml').write_bytes(b'0' * 5)
+    assert dataset_signature(str(tmp_path / 'dem.tif'))['size'] == 15
+
+
+@pytest.mark.parametrize('type, params, raster', [('unique', UNIQUE, landuse), ('range', RANGE, dem)])
+def test_remap_matches_per_cell_reference(type, params, raster):
+    c = Criteria(raster(), tile_config=TILES)
+    c.transform(type, copy.deepcopy(params))
+    assert np.array_equal(c.transformed_raster.data, reference_remap(c, type, params), equal_nan=True)
+
+
+def test_tiled_reads_match_source(tmp_path):
+    source = dem()
+    tiled = TiledRaster.from_raster(NumpyBackend(), source, str(tmp_path / 'dem'), tile_shape=(16, 7))
+    backend = TiledBackend()
+    # windows across stored tile borders, and the partial tiles at the raster edges
+    for row, col, nrows, ncols in [(3, 5, 20, 11), (0, 0, 67, 45), (60, 40, 7, 5), (10, 2, 1, 30)]:
+        expected = source.data[row:row + nrows, col:col + ncols]
+        assert np.array_equal(backend.read(tiled, row, col, nrows, ncols), expected, equal_nan=True)
+    # an aligned window is a view of the memory map
+    assert np.shares_memory(backend.read(tiled, 16, 7, 16, 7), tiled.tiles)
+    reopened = TiledRaster(tiled.path)
+    assert np.array_equal(backend.read(reopened, 0, 0, 67, 45), source.data, equal_nan=True)
+
+
+def test_temporary_maps_are_removed(tmp_path):
+    def folders():
+        return set(glob.glob(os.path.join(tempfile.gettempdir(), 'suitability_*')))
+
+    before = folders()
+    m = SuitabilityModel(tile_config=TILES)
+    for seed in (0, 2):
+        c = Criteria(TiledRaster.from_raster(NumpyBackend(), dem(seed), str(tmp_path / str(seed)), (16, 7)),
+                     tile_config=TILES)
+        c.transform('continous', continous('gaussian'))
+        m.add_criteria(c, seed + 1)
+    for _ in range(3):
+        m.calculate(full=True)
+    gc.collect()
+    # only the current map is kept
+    assert len(folders() - before) == 1
+    assert os.path.exists(m.suitability_map.path + '.raw')
+    del m
+    gc.collect()
+    assert folders() - before == set()
+
+
+def test_profiler_hooks_and_counters(tmp_path):
+    calls = []
+    profiler = Profiler(hooks=[lambda stage, record: calls.append((stage, dict(record)))])
+    cache = TransformCache(str(tmp_path))
+    for _ in range(2):
+        c = Criteria(dem(), tile_config=TILES, cache=cache, profiler=profiler)
+        c.transform('continous', continous('gaussian'))
+    m = SuitabilityModel(tile_config=TILES, profiler=profiler)
+    m.add_criteria(c, 1)
+    m.calculate()
+    summary = m.profile_summary()
+    assert [stage for stage, record in calls].count('transform') == summary['transform']['calls'] == 2
+    assert all(record['seconds'] >= 0 for stage, record in calls)
+    # the first transform misses the cache and the second one is served from it
+    transforms = [record for stage, record in calls if stage == 'transform']
+    assert transforms[0]['cache_misses'] > 0 and transforms[1]['cache_hits'] > 0
+    assert summary['calculate']['cells'] >= 67 * 45
+    assert summary['calculate']['bytes_written'] > 0
+    assert Criteria(dem(), tile_config=TILES).profiler.summary() == {}
+
+
+def test_preview_and_full_resolution():
+    m = model()
+    m.calculate()
+    full, full_stats = m.suitability_map.data.copy(), m.suitability_stats
+    m.preview(2)
+    # level 2 keeps the centre cell of every 4 by 4 block
+    assert np.array_equal(m.criteria[0].pyramid[2].data, dem().data[2::4, 2::4], equal_nan=True)
+    # only the requested level is built, as float32
+    assert list(m.criteria[0].pyramid) == [2] and m.criteria[0].pyramid[2].data.dtype == np.float32
+    # a level coarser than the tiles skips the tiles without a picked cell
+    c = Criteria(dem(), tile_config=TILES)
+    c.preview(4)
+    assert np.array_equal(c.pyramid[4].data, dem().data[8::16, 8::16], equal_nan=True)
+    m.calculate()
+    assert m.suitability_map.data.shape == level_shape(67, 45, 2)
+    error = m.preview_error()
+    assert error['sample_cells'] == m.suitability_stats.count
+    assert 0 < error['fraction'] < 1 and error['mean_stderr'] > 0
+    assert abs(m.suitability_stats.mean - full_stats.mean) < 5 * error['mean_stderr'] + 1e-6
+    assert m.criteria[0].preview_error() is not None
+    m.full_resolution()
+    assert m.preview_error() is None and m.criteria[0].preview_error() is None
+    m.calculate()
+    assert np.array_equal(m.suitability_map.data, full, equal_nan=True)
+    assert same_stats(m.suitability_stats, full_stats)
+
+
+def test_scenarios_match_model():
+    m = model()
+    batch = ScenarioBatch(m)
+    variant = batch.add_variant(1, 'continous', continous('gaussian'))
+    scenarios = [[1, 2, 3, 0], [4, 1, 2, 0], [1, 0, 3, 2]]
+    results = batch.run(scenarios, maps=(0, 1, 2))
+    for i, weights in enumerate(scenarios):
+        expected = model(weights[:3])
+        if weights[variant]:
+            expected.criteria[1].transform('continous', continous('gaussian'))
+            expected.weight[1] = weights[variant]
+        expected.calculate()
+        raster, backend = results.maps[i]
+        assert np.array_equal(np.isnan(raster.data), np.isnan(expected.suitability_map.data))
+        np.testing.assert_allclose(raster.data, expected.suitability_map.data, rtol=1e-6)
+        assert results.stats[i].count == expected.suitability_stats.count
+        assert results.stats[i].mean == pytest.approx(expected.suitability_stats.mean, rel=1e-6)
+
+
+def test_sampling_is_bounded_and_seeded():
+    sampling = Sampling('sample', 500, seed=3, window=(4, 4))
+    windows = list(sampling.windows(200, 300))
+    cells = sum(nrows * ncols for row, col, nrows, ncols in windows)
+    assert 0.8 * sampling.sample_size <= cells <= 1.2 * sampling.sample_size
+    assert all(0 <= row and row + nrows <= 200 and 0 <= col and col + ncols <= 300
+               for row, col, nrows, ncols in windows)
+    source = dem(shape=(200, 300))
+    stats = [Criteria(source, tile_config=TILES, sampling=Sampling('sample', 500, seed=seed, window=(4, 4))).stats
+             for seed in (3, 3, 4)]
+    assert 0 < stats[0].count <= cells
+    assert same_stats(stats[0], stats[1])
+    assert stats[0].as_dict() != stats[2].as_dict()
+    # the sample mean of a uniform raster is close to the full one
+    assert stats[0].mean == pytest.approx(np.nanmean(source.data), rel=0.1)
+
+
+def test_jobs_report_progress_and_cancel_cleanly():
+    m = model()
+    c = m.criteria[1]
+    job = c.transform_async('continous', continous('gaussian'))
+    assert job.result() is c and job.done()
+    # too late to stop a finished job, it is not reported as cancelled
+    job.cancel()
+    assert not job.cancelled() and job.result() is c
+    assert job.progress()['tiles_done'] == job.progress()['tiles_total'] > 0
+    expected = Criteria(dem(2), tile_config=TILES)
+    expected.transform('continous', continous('gaussian'))
+    assert np.array_equal(c.transformed_raster.data, expected.transformed_raster.data, equal_nan=True)
+    assert asyncio.run(wait(m.calculate_async())) is m
+    assert m.suitability_stats.count > 0
+    # cancelled from its own progress callback, after the first tile
+    job = c.transform_async('continous', continous('linear'), on_progress=lambda job: job.cancel())
+    with pytest.raises(Jobs.Cancelled):
+        job.result()
+    assert job.cancelled()
+    assert c.transform_args[1]['name'] == 'gaussian'
+    assert np.array_equal(c.transformed_raster.data, expected.transformed_raster.data, equal_nan=True)
+
+
+async def wait(job):
+    return await job
+
+
+def test_delta_matches_full():
+    m = model()
+    m.calculate()
+    assert m.last_calculation['mode'] == 'full'
+    m.calculate()
+    assert m.last_calculation == {'mode': 'unchanged', 'criteria': []}
+    # the first change keeps the weighted sum, the ones after it are deltas
+    assert m._state is None
+    m.criteria[0].transform('continous', continous('small'))
+    m.calculate()
+    assert m.last_calculation['mode'] == 'full' and m._state is not None
+    m.criteria[1].transform('continous', continous('gaussian'))
+    m.weight[2] = 5
+    m.calculate()
+    assert m.last_calculation == {'mode': 'delta', 'criteria': [1, 2]}
+    delta, delta_stats = m.suitability_map.data.copy(), m.suitability_stats
+    m.calculate(full=True)
+    assert np.array_equal(delta, m.suitability_map.data, equal_nan=True)
+    assert same_stats(delta_stats, m.suitability_stats)
+
+
+class Clipped(TransformFunction):
+    name = 'clipped'
+
+    def defaults(self, params, stats):
+        if 'ceiling' not in params:
+            params['ceiling'] = stats.mean
+
+    def bind(self, params, stats):
+        return lambda v: np.minimum(v, params['ceiling'])
+
+
+def test_registered_function_transforms_and_plots():
+    register(Clipped)
+    try:
+        c = Criteria(dem(), tile_config=TILES)
+        c.transform('continous', continous('clipped'))
+        data = dem().data.astype(np.float64)
+        clipped = np.minimum(data, c.mean_value)
+        expected = (clipped - np.nanmin(clipped)) / (np.nanmax(clipped) - np.nanmin(clipped)) * 9 + 1
+        np.testing.assert_allclose(c.transformed_raster.data, expected, rtol=1e-6)
+        assert np.array_equal(np.isnan(c.transformed_raster.data), np.isnan(data))
+        # the plot curve comes from the same function object
+        assert max(c.transformed_sample_values) == pytest.approx(10)
+        assert c.transformed_sample_values[0] == pytest.approx(1)
+    finally:
+        TRANSFORM_FUNCTIONS.pop('clipped')
+    with pytest.raises(ValueError):
+        Criteria(dem(), tile_config=TILES).transform('continous', continous('clipped'))
+
+
+@pytest.mark.parametrize('quantize', [None, 'uint8', 'uint16'])
+def test_export_round_trip(tmp_path, quantize):
+    m = model()
+    m.calculate()
+    expected = m.suitability_map.data
+    exported = m.export_map(str(tmp_path / 'map'), quantize)
+    raster = CompactRaster(exported.path)
+    values = CompactBackend().read(raster, 0, 0, 67, 45)
+    assert np.array_equal(np.isnan(values), np.isnan(expected))
+    if quantize is None:
+        assert np.array_equal(values, expected, equal_nan=True)
+    else:
+        assert raster.tolerance > 0
+        # float32 rounding of the decoded value on top of the quantization step
+        assert np.nanmax(np.abs(values - expected)) <= raster.tolerance + 1e-6 * np.nanmax(np.abs(expected))
+    assert same_stats(raster.accumulator(), m.suitability_stats)
+    # blocks without NoData store no bitmask
+    for (row, col), (nrows, ncols, start, n_data, n_mask) in raster.blocks.items():
+        assert (n_mask > 0) == np.isnan(expected[row:row + nrows, col:col + ncols]).any()
+
+
+def test_export_masks_only_blocks_with_nodata(tmp_path):
+    data = dem().data.copy()
+    data[np.isnan(data)] = 1000
+    data[20, 10] = np.nan
+    c = Criteria(NumpyRaster(data, name='dem'), tile_config=TILES)
+    c.transform('continous', continous('linear'))
+    raster = c.export(str(tmp_path / 'dem'), 'uint8')
+    masked = [(row, col) for (row, col), block in raster.blocks.items() if block[4] > 0]
+    assert masked == [(16, 7)]
+    values = CompactBackend().read(CompactRaster(raster.path), 0, 0, 67, 45)
+    assert np.array_equal(np.isnan(values), np.isnan(data))
+    np.testing.assert_allclose(values, c.transformed_raster.data, atol=raster.tolerance + 1e-5)
+
+
+def test_jobs_after_cancelled_transform():
+    m = model()
+    m.calculate()
+    c = m.criteria[0]
+    job = c.transform_async('continous', continous('gaussian'))
+    job.cancel()
+    # started again right away, while the cancelled job may still be winding down
+    c.transform_async('continous', continous('near')).result()
+    assert c.transform_args[1]['name'] == 'near'
+    assert m.calculate_async().result() is m
+
+
+def test_scenario_matches_model_with_zero_weight():
+    m = model(weights=(0, 1, 2))
+    batch = ScenarioBatch(m)
+    results = batch.run([[0, 1, 2]], maps=(0,))
+    m.calculate()
+    assert results.stats[0].count == m.suitability_stats.count
+    raster, backend = results.maps[0]
+    np.testing.assert_allclose(raster.data, m.suitability_map.data, rtol=1e-6)
+
+
+@pytest.mark.parametrize('name', ['mssmall', 'mslarge'])
+def test_nodata_stays_nodata(name):
+    c = Criteria(dem(), tile_config=TILES)
+    c.transform('continous', continous(name))
+    assert np.array_equal(np.isnan(c.transformed_raster.data), np.isnan(dem().data))
+    assert c.transformed_stats.count == np.count_nonzero(~np.isnan(dem().data))
+
+
+@pytest.mark.parametrize('name', RBF_NAMES)
+def test_continous_matches_per_cell_reference(name):
+    c = Criteria(dem(), tile_config=TILES)
+    c.transform('continous', continous(name))
+    expected = reference_continous(c, continous(name))
+    values = c.transformed_raster.data
+    assert np.array_equal(np.isnan(values), np.isnan(expected))
+    # float32 results, the vectorized and math module functions may differ in the last bit
+    np.testing.assert_allclose(values, expected, rtol=1e-6, atol=1e-6)
+
+
+def test_transform_keeps_a_private_copy_of_params(tmp_path):
+    params = continous('small')
+    c = Criteria(dem(), tile_config=TILES, cache=TransformCache(str(tmp_path)))
+    c.transform('continous', params)
+    # the defaults are filled in the caller's dict too, edits after the transform do not reach it
+    assert c.transform_args[1] == params and params['spread'] == 5
+    params['spread'] = 1
+    assert c.transform_args[1]['spread'] == 5
+    before = c.transformed_raster.data.copy()
+    c.preview(1)
+    c.full_resolution()
+    assert np.array_equal(c.transformed_raster.data, before, equal_nan=True)
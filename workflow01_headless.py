@@ -0,0 +1,111 @@
+import argparse
+import os
+import time
+from SuitabilityModel import *
+
+# same parameters as workflow01.ipynb
+c1_transform_params = {
+    'from_scale': 1,
+    'to_scale': 10,
+    'remap': {
+        (587, 935.8): 1,
+        (935.8, 1283.6): 2,
+        (1283.6, 1631.4): 3,
+        (1631.4, 1979.2): 4,
+        (1979.2, 2327): 5,
+        (2327, 2674.8): 6,
+        (2674.8, 3022.6): 7,
+        (3022.6, 3370.4): 8,
+        (3370.4, 3718.2): 9,
+        (3718.2, 4066): 10,
+    }
+}
+
+c2_transform_params = {
+    'name': 'mssmall',
+    'from_scale': 1,
+    'to_scale': 10
+}
+
+c3_transform_params = {
+    'from_scale': 1,
+    'to_scale': 10,
+    'remap': {
+        5: 1,
+        7: 1,
+        11: 1,
+        12: 1,
+        13: 1,
+        14: 1,
+        17: 1,
+        24: 1,
+        41: 10,
+        42: 10,
+        43: 10,
+        61: 1,
+        62: 1,
+        211: 1,
+        212: 1
+    }
+}
+
+
+def synthetic_inputs(rows, cols, seed=0):
+    # stand-ins for dem_24, dist_streams and landuse2002 with the same value ranges
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols]
+    dem = 587 + (4066 - 587) * (0.5 + 0.25 * np.sin(x / 97.0) + 0.25 * np.cos(y / 131.0))
+    dem += rng.normal(0, 25, (rows, cols))
+    dist = np.abs(np.sin(x / 53.0) * np.cos(y / 71.0)) * 5000
+    classes = np.array([5, 7, 11, 12, 13, 14, 17, 24, 41, 42, 43, 61, 62, 211, 212])
+    landuse = classes[(x // 64 + y // 48) % classes.size]
+    nodata = rng.random((rows, cols)) < 0.02
+    return [NumpyRaster(dem.astype(np.float32), nodata, name='dem_24'),
+            NumpyRaster(dist.astype(np.float32), nodata, name='dist_streams'),
+            NumpyRaster(landuse.astype(np.int32), nodata, name='landuse2002')]
+
+
+def load_inputs(data_dir):
+    # dem_24.npz, dist_streams.npz and landuse2002.npz written with NumpyRaster.save
+    return [NumpyRaster.load(os.path.join(data_dir, name + '.npz'))
+            for name in ('dem_24', 'dist_streams', 'landuse2002')]
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print('{:<28}{:10.3f} s'.format(label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the workflow01 notebook without arcpy and time each step')
+    parser.add_argument('--data', help='directory with dem_24.npz, dist_streams.npz and landuse2002.npz')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--cols', type=int, default=2000)
+    parser.add_argument('--tile', type=int, nargs=2, default=DEFAULT_TILE_SHAPE)
+    parser.add_argument('--workers', type=int, default=1, help='threads computing tiles concurrently')
+    parser.add_argument('--cache', help='TransformCache directory, a second run starts warm')
+    args = parser.parse_args()
+
+    rasters = load_inputs(args.data) if args.data else synthetic_inputs(args.rows, args.cols)
+    tile_config = TileConfig(args.tile, workers=args.workers)
+    cache = TransformCache(args.cache) if args.cache else None
+    c1, c2, c3 = [timed('Criteria({})'.format(r.name), Criteria, r, tile_config, None, cache) for r in rasters]
+    timed('c1.transform(range)', c1.transform, 'range', c1_transform_params)
+    timed('c2.transform(mssmall)', c2.transform, 'continous', c2_transform_params)
+    timed('c3.transform(unique)', c3.transform, 'unique', c3_transform_params)
+
+    s = SuitabilityModel(weight_method='multiplier', tile_config=tile_config)
+    s.add_criteria(c1, 1)
+    s.add_criteria(c2, 1)
+    timed('s.calculate()', s.calculate)
+    s.show_stats()
+    if args.workers > 1:
+        report = s.compare_parallel(args.workers)
+        print('serial {serial_seconds:.3f} s, {workers} workers {parallel_seconds:.3f} s, '
+              'speedup {speedup:.2f}x, identical {identical}'.format(**report))
+
+
+if __name__ == "__main__":
+    main()